@@ -1,11 +1,18 @@
+import threading
 import tkinter
 import urllib
+from types import MappingProxyType
 
-from layout import DocumentLayout, DrawText, DrawOutline, DrawRect, DrawLine
+from canvas_layer import CanvasLayer
+from loader import PageLoader
+from scheduler import FrameScheduler
+from layout import DisplayListIndex, DocumentLayout, HitTestIndex, InputLayout, DrawText, DrawOutline, DrawRect, DrawLine
 from html.element import Element, Text
-from css.parser import CSSParser, TagSelector
+from css.cascade import AncestorFilter, RuleIndex
+from css.parser import CSSParser
 from html.parser import HTMLParser
-from utils.fonts import get_font
+from utils.fonts import get_font, set_metrics_backend
+from utils.metrics import GlyphTableMetrics
 from utils.shape import Rect
 from utils.url import URL
 from utils.config import Config
@@ -23,7 +30,7 @@ class Chrome:
     def __init__(self, browser):
         self.browser = browser
         self.font = get_font(20, "normal", "roman")
-        self.font_height = self.font.metrics("linespace")
+        self.font_height = self.font.linespace
         self.padding = 5
         self.tabbar_top = 0
         self.tabbar_bottom = self.font_height + 2*self.padding
@@ -50,12 +57,24 @@ class Chrome:
             Config.width - self.padding,
             self.urlbar_bottom - self.padding)
 
+        self.tab_width = self.font.measure("Tab X") + 2*self.padding
+        self.loading_width = self.font.measure("Loading...")
+
         self.focus = None
         self.address_bar = ""
 
+        # The display list is kept until what it shows changes, see display_index()
+        self.display_list = []
+        self.index = None
+        self.painted_state = None
+        # Where the address bar's commands start in the display list
+        self.address_start = 0
+        # Areas repainted since the last draw
+        self.damage = []
+
     def tab_rect(self, i):
         tabs_start = self.newtab_rect.right + self.padding
-        tab_width = self.font.measure("Tab X") + 2*self.padding
+        tab_width = self.tab_width
         return Rect(
             tabs_start + tab_width * i, self.tabbar_top,
             tabs_start + tab_width * (i + 1), self.tabbar_bottom)
@@ -68,7 +87,8 @@ class Chrome:
             self.browser.active_tab.go_back()
         elif self.address_rect.contains_point(x, y):
             self.focus = "address bar"
-            self.address_bar = ""
+            # Through set_address_bar, so the cached display list stops showing the old text
+            self.set_address_bar("")
         else:
             for i, tab in enumerate(self.browser.tabs):
                 if self.tab_rect(i).contains_point(x, y):
@@ -108,6 +128,13 @@ class Chrome:
                     bounds.right, bounds.bottom, Config.width, bounds.bottom,
                     "black", 1))
 
+        # Draw loading indicator
+        if self.browser.active_tab and self.browser.active_tab.loading:
+            cmds.append(DrawText(
+                Config.width - self.padding - self.loading_width,
+                self.tabbar_top + self.padding,
+                "Loading...", self.font, "gray"))
+
         # Draw back button
         cmds.append(DrawOutline(self.back_rect, "black", 1))
         cmds.append(DrawText(
@@ -115,7 +142,12 @@ class Chrome:
             self.back_rect.top,
             "<", self.font, "black"))
 
-        # Draw address bar
+        self.address_start = len(cmds)
+        cmds.extend(self.paint_address_bar())
+        return cmds
+
+    def paint_address_bar(self):
+        cmds = []
         cmds.append(DrawOutline(self.address_rect, "black", 1))
         if self.focus == "address bar":
             cmds.append(DrawText(
@@ -139,10 +171,46 @@ class Chrome:
 
     def keypress(self, char):
         if self.focus == "address bar":
-            self.address_bar += char
+            self.set_address_bar(self.address_bar + char)
             return True
         return False
 
+    def state(self):
+        """Everything the chrome paints, except the address bar text while it is edited"""
+        active = self.browser.active_tab
+        return (len(self.browser.tabs), active, str(active.url) if active else None,
+                active.loading if active else False, self.focus, Config.width)
+
+    def display_index(self) -> DisplayListIndex:
+        """The chrome's display list, painted again only when what it shows changed"""
+        state = self.state()
+        if state != self.painted_state:
+            self.painted_state = state
+            self.display_list = self.paint()
+            self.index = DisplayListIndex(self.display_list)
+            self.damage = []
+        return self.index
+
+    def set_address_bar(self, text):
+        old_rect = self.address_paint_rect()
+        self.address_bar = text
+        if self.index is None:
+            return
+        # Replace the address bar in the display list, and only repaint its area
+        cmds = self.paint_address_bar()
+        old_cmds = self.display_list[self.address_start:]
+        if len(cmds) != len(old_cmds) or any(
+                cmd.top != old.top or cmd.bottom != old.bottom for cmd, old in zip(cmds, old_cmds)):
+            self.painted_state = None
+            return
+        self.display_list[self.address_start:] = cmds
+        self.damage.append(old_rect.union(self.address_paint_rect()))
+
+    def address_paint_rect(self):
+        """The area the address bar paints on, its text can go past the right edge"""
+        right = self.address_rect.left + self.padding + self.font.measure(self.address_bar) + 1
+        return self.address_rect.union(Rect(right, self.address_rect.top, right, self.address_rect.bottom))
+
     def enter(self):
         if self.focus == "address bar":
             self.browser.active_tab.load(URL(self.address_bar))
@@ -150,7 +218,7 @@ class Chrome:
 
     def backspace(self):
         if self.focus == "address bar" and self.address_bar:
-            self.address_bar = self.address_bar[:-1]
+            self.set_address_bar(self.address_bar[:-1])
             return True
         return False
 
@@ -170,6 +238,8 @@ class Browser:
             bg="white"
         )
         self.canvas.pack(fill=tkinter.BOTH, expand=True)
+        if Config.METRICS_BACKEND == "table":
+            set_metrics_backend(GlyphTableMetrics(Config.GLYPH_CACHE_FILE, self.window))
         self.window.bind("<Down>", self.scrolldown)
         self.window.bind("<Up>", self.scrollup)
         self.window.bind("<MouseWheel>", self.scroll_mouse_wheel)
@@ -178,20 +248,37 @@ class Browser:
         self.window.bind("<Key>", self.handle_key)
         self.window.bind("<Return>", self.handle_enter)
         self.window.bind("<BackSpace>", self.handle_backspace)
+        self.window.protocol("WM_DELETE_WINDOW", self.close)
 
         self.chrome = Chrome(self)
         self.focus = None
+        # Page content is kept on the canvas between frames, under the chrome
+        self.content = CanvasLayer(self.canvas, "content", below="chrome")
+        self.chrome_layer = CanvasLayer(self.canvas, "chrome")
+
+        # Input waiting for the next frame
+        self.pending_scroll = 0
+        self.pending_resize = None
+        self.scheduler = FrameScheduler(self.window, self.frame)
+        self.loader = PageLoader(self.window)
+
+    def close(self):
+        """Stop every load so the loader threads exit, then close the window"""
+        for tab in self.tabs:
+            tab.stop()
+        self.loader.shutdown()
+        self.window.destroy()
 
     def handle_backspace(self, e: tkinter.Event):
         if self.chrome.backspace():
-            self.draw()
+            self.scheduler.schedule()
         elif self.focus == "content":
             self.active_tab.backspace()
-            self.draw()
+            self.scheduler.schedule()
 
     def handle_enter(self, e: tkinter.Event):
         self.chrome.enter()
-        self.draw()
+        self.scheduler.schedule()
 
     def handle_key(self, e: tkinter.Event):
         if len(e.char) == 0:
@@ -200,12 +287,14 @@ class Browser:
             return
 
         if self.chrome.keypress(e.char):
-            self.draw()
+            self.scheduler.schedule()
         elif self.focus == "content":
             self.active_tab.keypress(e.char)
-            self.draw()
+            self.scheduler.schedule()
 
     def click(self, e: tkinter.Event):
+        # Hit testing needs the page as it is on screen
+        self.apply_pending()
         if e.y < self.chrome.bottom:
             self.focus = None
             self.chrome.click(e.x, e.y)
@@ -213,47 +302,70 @@ class Browser:
             self.focus = "content"
             self.chrome.blur()
             self.active_tab.click(e, self.chrome.bottom)
-        self.draw()
+        self.scheduler.schedule()
 
     def scrolldown(self, e):
-        self.active_tab.scrolldown(e)
-        self.draw()
+        self.pending_scroll += Config.SCROLL_STEP
+        self.scheduler.schedule()
 
     def scrollup(self, e):
-        self.active_tab.scrollup(e)
-        self.draw()
+        self.pending_scroll -= Config.SCROLL_STEP
+        self.scheduler.schedule()
 
     def resize(self, e: tkinter.Event):
-        self.active_tab.resize(e)
-        self.draw()
+        # Only the last size before a frame is laid out
+        self.pending_resize = e
+        self.scheduler.schedule()
 
     def scroll_mouse_wheel(self, e: tkinter.Event):
-        self.active_tab.scroll_mouse_wheel(e)
+        self.pending_scroll -= 7 * e.delta
+        self.scheduler.schedule()
+
+    def apply_pending(self):
+        """Apply the input received since the last frame to the active tab"""
+        if self.pending_resize:
+            self.active_tab.resize(self.pending_resize)
+            self.pending_resize = None
+        if self.pending_scroll:
+            self.active_tab.scroll_by(self.pending_scroll)
+            self.pending_scroll = 0
+        self.active_tab.render_if_needed()
+
+    def frame(self):
+        self.apply_pending()
         self.draw()
 
     def draw(self):
-        self.canvas.delete("all")
-        self.active_tab.draw(self.canvas, self.chrome.bottom)
+        self.canvas.delete("scrollbar")
+        self.active_tab.draw(self.canvas, self.content, self.chrome.bottom)
+        self.draw_chrome()
 
-        for cmd in self.chrome.paint():
-            cmd.execute(0, self.canvas)
+    def draw_chrome(self):
+        """Draw the chrome if it changed, or only the areas it recorded as damaged"""
+        self.chrome_layer.show(self.chrome.display_index(), 0, 0, self.chrome.bottom)
+        for rect in self.chrome.damage:
+            self.chrome_layer.repaint(rect)
+        self.chrome.damage = []
 
     def new_tab(self, url):
-        new_tab = Tab(Config.height - self.chrome.bottom)
-        new_tab.load(url)
+        new_tab = Tab(Config.height - self.chrome.bottom, self.scheduler.schedule, self.loader)
         self.active_tab = new_tab
         self.tabs.append(new_tab)
+        new_tab.load(url)
         self.draw()
 
 
 class Tab:
-    def __init__(self,tab_height):
+    def __init__(self, tab_height, on_progress=None, loader: PageLoader = None):
         self.layout = None
         self.display_list = []
+        self.display_index = DisplayListIndex([])
+        self.hit_index = None
         self.nodes = None
         self.view_source_enable = False
         self.document = None
         self.rules = DEFAULT_STYLE_SHEET.copy()
+        self.rule_index = RuleIndex(self.rules, cascade_priority)
 
         self.scroll = 0
         self.max_scroll = 0
@@ -266,9 +378,29 @@ class Tab:
 
         self.history = []
         self.focus = None
+        # Set when a change should be rendered with the next frame
+        self.needs_render = False
+        # Painted inputs: node -> (layout object, start and end in the display list)
+        self.input_commands = {}
+        # Inputs to paint again with the next frame, and the area they painted before
+        self.repaint_rects = {}
+        # Areas of the page repainted since the last draw
+        self.damage = []
+        # Called after the page was rendered while loading, and when loading finishes
+        self.on_progress = on_progress
+
+        # Pages are loaded in the background when there is a loader, see load()
+        self.loader = loader
+        self.loading = False
+        # Incremented by every load, so a load can tell it has been replaced
+        self.generation = 0
+        # Set by the Tk thread when it is done with a partial tree from the loading thread
+        self.handoff = None
+        self.first_screen_painted = False
 
     def scrolldown(self, e, scroll_step=Config.SCROLL_STEP):
         self.scroll = min(self.scroll + scroll_step, self.max_scroll)
+        self.extend_layout()
 
     def scrollup(self, e, scroll_step=Config.SCROLL_STEP):
         self.scroll = max(self.scroll - scroll_step, 0)
@@ -279,15 +411,61 @@ class Tab:
         else:
             self.scrolldown(e, -7 * e.delta)
 
+    def scroll_by(self, dy):
+        if dy > 0:
+            self.scrolldown(None, dy)
+        elif dy < 0:
+            self.scrollup(None, -dy)
+
     def backspace(self):
         value = self.focus.attributes["value"]
-        self.focus.attributes["value"] = value[:-1]
-        self.render()
+        self.set_value(value[:-1])
 
     def keypress(self, char):
         if self.focus:
-            self.focus.attributes["value"] += char
+            self.set_value(self.focus.attributes["value"] + char)
+
+    def set_value(self, value):
+        """Change the value of the focused input, to be repainted with the next frame"""
+        if self.focus not in self.repaint_rects:
+            painted = self.input_commands.get(self.focus)
+            self.repaint_rects[self.focus] = painted[0].paint_rect() if painted else None
+        self.focus.set_attribute("value", value)
+        self.needs_render = True
+
+    def render_if_needed(self):
+        """Render the changes made since the last render, see keypress()"""
+        if not self.needs_render:
+            return
+        # The loading thread may still be building the tree
+        if self.loading:
+            return
+        relayout = (self.nodes.needs_style or self.nodes.child_needs_style
+                    or self.nodes.needs_layout or self.nodes.child_needs_layout)
+        if relayout or not self.repaint_inputs():
             self.render()
+        self.needs_render = False
+
+    def repaint_inputs(self) -> bool:
+        """
+        Paint the inputs whose value changed again, replacing their commands in the display
+        list and recording the damaged area. Return False if the display list has to be
+        painted again instead, because what an input paints moved
+        """
+        repaint_rects = self.repaint_rects
+        self.repaint_rects = {}
+        for node, old_rect in repaint_rects.items():
+            if old_rect is None:
+                return False
+            obj, start, end = self.input_commands[node]
+            cmds = obj.paint()
+            old_cmds = self.display_list[start:end]
+            if len(cmds) != len(old_cmds) or any(
+                    cmd.top != old.top or cmd.bottom != old.bottom for cmd, old in zip(cmds, old_cmds)):
+                return False
+            self.display_list[start:end] = cmds
+            self.damage.append(old_rect.union(obj.paint_rect()))
+        return True
 
     def submit_form(self, elt):
         # Find all input tag in that form
@@ -311,13 +489,10 @@ class Tab:
         x, y = e.x, e.y
         y += self.scroll - offset_y
 
-        objs = [obj for obj in tree_to_list(self.document, [])
-                if obj.x <= x < obj.x + obj.width
-                and obj.y <= y < obj.y + obj.height]
-
-        if not objs:
+        obj = self.hit_test(x, y)
+        if obj is None:
             return
-        elt = objs[-1].node
+        elt = obj.node
         while elt:
             if isinstance(elt, Text):
                 pass
@@ -326,11 +501,14 @@ class Tab:
                 print("Going to:", url.full_url)
                 return self.load(url)
             elif elt.tag == "input":
-                elt.attributes["value"] = ""
+                if self.loading:
+                    return
+                elt.set_attribute("value", "")
 
                 # Un-focus the previously focused element
                 if self.focus:
                     self.focus.is_focused = False
+                    self.focus.invalidate_layout()
                 self.focus = elt
                 elt.is_focused = True
                 return self.render()
@@ -345,11 +523,12 @@ class Tab:
         if Config.width != e.width or Config.height != e.height:
             Config.width = e.width
             Config.height = e.height
-            self.document = DocumentLayout(self.nodes)
-            self.document.layout()
+            if self.document is None or self.loading:
+                # Laid out with the new size when loading finishes
+                return
+            self.document.layout(self.layout_limit())
             self.calculate_scrolling()
-            self.display_list = []
-            paint_tree(self.document, self.display_list)
+            self.paint()
 
     def go_back(self):
         if self.history:
@@ -361,54 +540,177 @@ class Tab:
         print("Loading...")
         self.history.append(url)
         self.url = url
-        body = url.request(payload)
-        print(body)
         self.view_source_enable = (url.scheme == "view-source")
-        self.nodes = HTMLParser(body).parse()
-
-        # Build the CSS rules
-        links = [node.attributes["href"]
-                 for node in tree_to_list(self.nodes, [])
-                 if isinstance(node, Element)
-                 and node.tag == "link"
-                 and node.attributes.get("rel") == "stylesheet"
-                 and "href" in node.attributes]
-
-        for link in links:
-            style_url = url.resolve(link)
-            try:
-                body = style_url.request()
-            except:
-                continue
-            self.rules.extend(CSSParser(body).parse())
+
+        self.stop()
+
+        self.first_screen_painted = self.on_progress is None
+        if self.loader is None:
+            self.fetch(url, payload, self.generation, lambda function, *args: function(*args))
+        else:
+            self.loading = True
+            self.loader.submit(self.fetch, url, payload, self.generation, self.loader.post)
+
+    def stop(self):
+        """Abandon the current load, its thread returns at its next check"""
+        self.generation += 1
+        # Release a loading thread waiting on a partial render that will not happen
+        handoff = self.handoff
+        if handoff is not None:
+            handoff.set()
+
+    def fetch(self, url: URL, payload, generation: int, post):
+        """
+        Download and parse the page and its stylesheets. Runs on a loader thread, and hands
+        partial and final results to the Tk thread with `post`
+        """
+        try:
+            # Render what has arrived so far until the first screenful is painted
+            parser = HTMLParser()
+            received = 0
+            next_render = Config.PROGRESSIVE_RENDER_STEP
+            for chunk in url.stream(payload):
+                # Returning drops the stream, which closes its connection
+                if generation != self.generation:
+                    return
+                parser.feed(chunk)
+                received += len(chunk)
+                if not self.first_screen_painted and received >= next_render:
+                    next_render = received + Config.PROGRESSIVE_RENDER_STEP
+                    nodes = parser.snapshot()
+                    if nodes:
+                        # Keep the tree as it is until the Tk thread has rendered it
+                        handoff = threading.Event()
+                        self.handoff = handoff
+                        post(self.show_partial, generation, nodes, handoff)
+                        while not handoff.wait(Config.HANDOFF_POLL_INTERVAL):
+                            if generation != self.generation:
+                                return
+            if generation != self.generation:
+                return
+            nodes = parser.close()
+
+            # Build the CSS rules
+            links = [node.attributes["href"]
+                     for node in tree_to_list(nodes, [])
+                     if isinstance(node, Element)
+                     and node.tag == "link"
+                     and node.attributes.get("rel") == "stylesheet"
+                     and "href" in node.attributes]
+
+            rules = []
+            for link in links:
+                if generation != self.generation:
+                    return
+                style_url = url.resolve(link)
+                try:
+                    body = style_url.request()
+                except:
+                    continue
+                rules.extend(CSSParser(body).parse())
+        except Exception:
+            post(self.finish_load, generation, None, [])
+            raise
+        post(self.finish_load, generation, nodes, rules)
+
+    def show_partial(self, generation: int, nodes, handoff: threading.Event):
+        """Render a partially parsed page, while its loading thread waits for `handoff`"""
+        try:
+            if generation != self.generation:
+                return
+            if nodes is not self.nodes:
+                # The focused input belonged to the previous page
+                self.focus = None
+            self.nodes = nodes
+            # The tree grew since the last partial render
+            self.nodes.invalidate_style()
+            self.render()
+            self.first_screen_painted = self.document.height >= self.tab_height
+            self.on_progress()
+        finally:
+            if self.handoff is handoff:
+                self.handoff = None
+            handoff.set()
+
+    def finish_load(self, generation: int, nodes, rules: list):
+        """Render the loaded page, `nodes` is None if loading it failed"""
+        if generation != self.generation:
+            return
+        self.loading = False
+        if nodes is None:
+            if self.on_progress:
+                self.on_progress()
+            return
+        # The focused input belonged to the previous page
+        self.focus = None
+        self.nodes = nodes
+        self.rules.extend(rules)
+        self.rule_index = RuleIndex(self.rules, cascade_priority)
+        self.nodes.invalidate_style()
 
         self.render()
+        if self.on_progress:
+            self.on_progress()
 
     def render(self):
-        style(self.nodes, sorted(self.rules, key=cascade_priority))
+        self.needs_render = False
+        restyle(self.nodes, self.rule_index)
 
-        self.document = DocumentLayout(self.nodes)
-        self.document.layout()
+        # Layout objects are kept across renders, only invalidated subtrees are redone
+        if self.document is None or self.document.node is not self.nodes:
+            self.document = DocumentLayout(self.nodes)
+        self.document.layout(self.layout_limit())
         # print_tree(self.document)
 
         self.calculate_scrolling()
 
+        self.paint()
+
+    def paint(self):
         self.display_list = []
-        paint_tree(self.document, self.display_list)
+        self.input_commands = {}
+        self.hit_index = HitTestIndex()
+        paint_tree(self.document, self.display_list, self.input_commands, self.hit_index)
+        self.display_index = DisplayListIndex(self.display_list)
+        self.repaint_rects = {}
+        self.damage = []
+
+    def hit_test(self, x, y):
+        """The deepest layout object at page coordinates (x, y), or None"""
+        if self.hit_index is None:
+            return None
+        return self.hit_index.hit_test(x, y)
+
+    def layout_limit(self):
+        """How far down the page has to be laid out for the current scroll position"""
+        if not Config.LAZY_LAYOUT:
+            return None
+        return self.scroll + self.tab_height + Config.LAYOUT_MARGIN
+
+    def extend_layout(self):
+        """Continue a lazy layout when scrolling gets close to the end of the laid out part"""
+        if self.document is None or self.document.complete or self.loading:
+            return
+        if self.document.y + self.document.height >= self.scroll + self.tab_height + Config.LAYOUT_MARGIN / 2:
+            return
+        self.document.layout(self.layout_limit())
+        self.calculate_scrolling()
+        self.scroll = min(self.scroll, self.max_scroll)
+        self.paint()
 
     def calculate_scrolling(self):
-        self.max_scroll = max(self.document.height + 2 * Config.VSTEP - self.tab_height, 0)
+        # Until the layout is complete the height of the rest of the page is estimated
+        height = self.document.estimated_height()
+        self.max_scroll = max(height + 2 * Config.VSTEP - self.tab_height, 0)
         self.scroll_bar_x0 = Config.width - Config.HSTEP + 2
         self.scroll_bar_x1 = Config.width - 2
         self.scroll_bar_height = Config.height / (self.max_scroll + Config.height) * Config.height
 
-    def draw(self, canvas, offset=0):
-        for cmd in self.display_list:
-            if cmd.top > self.scroll + self.tab_height:
-                continue
-            if cmd.bottom < self.scroll:
-                continue
-            cmd.execute(self.scroll - offset, canvas)
+    def draw(self, canvas, layer: CanvasLayer, offset=0):
+        layer.show(self.display_index, self.scroll, offset, self.tab_height)
+        for rect in self.damage:
+            layer.repaint(rect)
+        self.damage = []
 
         self.draw_scrollbar(canvas, offset)
 
@@ -419,51 +721,115 @@ class Tab:
                                     y0,
                                     self.scroll_bar_x1,
                                     y0 + self.scroll_bar_height,
-                                    fill="red")
+                                    fill="red",
+                                    tags="scrollbar")
 
 
-def paint_tree(layout_object, display_list: list):
+def paint_tree(layout_object, display_list: list, inputs: dict = None, hits: HitTestIndex = None):
+    """
+    :param inputs: if given, filled with where each input's commands are in the display list
+    :param hits: if given, every layout object is added to it
+    """
+    if hits is not None:
+        hits.add(layout_object)
     if layout_object.should_paint():
+        start = len(display_list)
         display_list.extend(layout_object.paint())
+        if inputs is not None and isinstance(layout_object, InputLayout):
+            inputs[layout_object.node] = (layout_object, start, len(display_list))
     else:
         a = 1
 
     for child in layout_object.children:
-        paint_tree(child, display_list)
+        paint_tree(child, display_list, inputs, hits)
 
 
-def style(node, rules: list):
-    node.style = {}
+def style(node, rules: RuleIndex, ancestors: AncestorFilter = None, shared: dict = None):
+    """
+    Compute the style of every node in the tree.
+    Nodes whose parents share a computed style, and which have the same tag, matched
+    rules and inline style, share one read-only computed style object
+    """
+    if ancestors is None:
+        ancestors = AncestorFilter()
+    if shared is None:
+        shared = {}
+
+    matched = [body for selector, body in rules.candidates(node)
+               if selector.matches(node, ancestors)]
+    if isinstance(node, Element):
+        tag = node.tag
+        inline = node.attributes.get("style")
+    else:
+        tag = None
+        inline = None
+    parent_style = node.parent.style if node.parent else None
+
+    # Parent styles stay alive for the whole pass, so their ids can't be reused
+    key = (id(parent_style), tag, tuple(id(body) for body in matched), inline)
+    computed = shared.get(key)
+    if computed is None:
+        computed = compute_style(parent_style, matched, inline)
+        shared[key] = computed
+    if node.style != computed:
+        # Text is laid out as part of its parent
+        if isinstance(node, Element):
+            node.invalidate_layout()
+        else:
+            node.parent.invalidate_layout()
+    node.style = computed
+
+    if isinstance(node, Element):
+        node.needs_style = False
+        node.child_needs_style = False
+        ancestors.push(node.tag)
+        for child in node.children:
+            style(child, rules, ancestors, shared)
+        ancestors.pop(node.tag)
+
+
+def restyle(node, rules: RuleIndex, ancestors: AncestorFilter = None):
+    """Restyle only the subtrees whose style was invalidated"""
+    if ancestors is None:
+        ancestors = AncestorFilter()
+    if node.needs_style:
+        style(node, rules, ancestors)
+    elif node.child_needs_style:
+        node.child_needs_style = False
+        ancestors.push(node.tag)
+        for child in node.children:
+            restyle(child, rules, ancestors)
+        ancestors.pop(node.tag)
+
+
+def compute_style(parent_style, matched: list, inline):
+    style_ = {}
     # Set defaut properties
     for property_, default_value in Config.INHERITED_PROPERTIES.items():
-        if node.parent:
-            node.style[property_] = node.parent.style[property_]
+        if parent_style is not None:
+            style_[property_] = parent_style[property_]
         else:
-            node.style[property_] = default_value
+            style_[property_] = default_value
 
-    for selector, body in rules:
-        if not selector.matches(node):
-            continue
+    for body in matched:
         for property_, value in body.items():
-            node.style[property_] = value
+            style_[property_] = value
 
     # Inline CSS
-    if isinstance(node, Element) and "style" in node.attributes:
-        pairs = CSSParser(node.attributes["style"]).body()
+    if inline is not None:
+        pairs = CSSParser(inline).body()
         for property_, value in pairs.items():
-            node.style[property_] = value
+            style_[property_] = value
 
-    if node.style["font-size"].endswith("%"):
-        if node.parent:
-            parent_font_size = node.parent.style["font-size"]
+    if style_["font-size"].endswith("%"):
+        if parent_style is not None:
+            parent_font_size = parent_style["font-size"]
         else:
             parent_font_size = Config.INHERITED_PROPERTIES["font-size"]
-        node_pct = float(node.style["font-size"][:-1]) / 100
+        node_pct = float(style_["font-size"][:-1]) / 100
         parent_px = float(parent_font_size[:-2])
-        node.style["font-size"] = str(node_pct * parent_px) + "px"
-
-    for child in node.children:
-        style(child, rules)
+        style_["font-size"] = str(node_pct * parent_px) + "px"
+    return MappingProxyType(style_)
 
 
 def tree_to_list(tree, li):
@@ -0,0 +1,107 @@
+import tkinter
+from bisect import bisect_left, bisect_right, insort
+
+from layout import DisplayListIndex
+from utils.shape import Rect
+
+
+class CanvasLayer:
+    """
+    Retained canvas items for one display list. Items are created the first time their
+    band of the page becomes visible, and stay on the canvas; scrolling moves them all
+    with canvas.move instead of creating them again. A new display list starts over
+    """
+    BAND_HEIGHT = 512
+    # Slack around a damaged area for items drawn slightly past their bounds
+    MARGIN = 2
+
+    def __init__(self, canvas: tkinter.Canvas, tag: str, below: str = None):
+        """
+        :param tag: canvas tag of every item in this layer
+        :param below: tag of the items this layer has to stay below
+        """
+        self.canvas = canvas
+        self.tag = tag
+        self.below = below
+        self.index = None
+        self.offset = 0
+        self.scroll = 0
+        # Bands of BAND_HEIGHT pixels whose commands have been created
+        self.bands = set()
+        # Display list positions of the created commands, sorted, their canvas items and back
+        self.created = []
+        self.items = {}
+        self.positions = {}
+
+    def show(self, index: DisplayListIndex, scroll, offset, height):
+        """Show the part of the page from `scroll` to `scroll + height` at canvas y `offset`"""
+        if index is not self.index or offset != self.offset:
+            self.clear()
+            self.index = index
+            self.offset = offset
+            self.scroll = scroll
+        elif scroll != self.scroll:
+            self.canvas.move(self.tag, 0, self.scroll - scroll)
+            self.scroll = scroll
+
+        created = False
+        first = int(scroll // self.BAND_HEIGHT)
+        last = int((scroll + height) // self.BAND_HEIGHT)
+        for band in range(first, last + 1):
+            if band in self.bands:
+                continue
+            self.bands.add(band)
+            top = band * self.BAND_HEIGHT
+            for i in index.positions(top, top + self.BAND_HEIGHT):
+                if i not in self.items:
+                    self.materialize(i)
+                    created = True
+        if created and self.below and self.canvas.find_withtag(self.below):
+            self.canvas.tag_lower(self.tag, self.below)
+
+    def repaint(self, damage: Rect):
+        """
+        Recreate the items inside `damage`, a rectangle of the page whose commands were
+        replaced in the display list in place
+        """
+        if self.index is None:
+            return
+        dy = self.offset - self.scroll
+        enclosed = self.canvas.find_enclosed(damage.left - self.MARGIN, damage.top + dy - self.MARGIN,
+                                             damage.right + self.MARGIN, damage.bottom + dy + self.MARGIN)
+        for item in enclosed:
+            i = self.positions.pop(item, None)
+            if i is not None:
+                self.canvas.delete(item)
+                del self.items[i]
+                self.created.pop(bisect_left(self.created, i))
+        for i in self.index.positions(damage.top, damage.bottom):
+            cmd = self.index.display_list[i]
+            if i not in self.items and self.is_shown(cmd):
+                self.materialize(i)
+        if self.below and self.canvas.find_withtag(self.below):
+            self.canvas.tag_lower(self.tag, self.below)
+
+    def is_shown(self, cmd) -> bool:
+        first = int(cmd.top // self.BAND_HEIGHT)
+        last = int(cmd.bottom // self.BAND_HEIGHT)
+        return any(band in self.bands for band in range(first, last + 1))
+
+    def materialize(self, i: int):
+        cmd = self.index.display_list[i]
+        item = cmd.execute(self.scroll - self.offset, self.canvas, (self.tag,))
+        # Keep the paint order when a command is created after ones painted over it
+        after = bisect_right(self.created, i)
+        if after < len(self.created):
+            self.canvas.tag_lower(item, self.items[self.created[after]])
+        insort(self.created, i)
+        self.items[i] = item
+        self.positions[item] = i
+
+    def clear(self):
+        self.canvas.delete(self.tag)
+        self.index = None
+        self.bands = set()
+        self.created = []
+        self.items = {}
+        self.positions = {}
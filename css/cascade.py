@@ -0,0 +1,82 @@
+from css.parser import TagSelector, DescendantSelector
+from html.element import Element
+
+
+def rightmost_tag(selector):
+    """The tag the node itself must have for `selector` to match it, None if any node may match"""
+    while isinstance(selector, DescendantSelector):
+        selector = selector.descendant
+    if isinstance(selector, TagSelector):
+        return selector.tag
+    return None
+
+
+class RuleIndex:
+    """
+    Rules bucketed by the tag of their rightmost selector, so a node is only tested
+    against rules that can match it. Candidates come out in cascade order
+    """
+
+    def __init__(self, rules: list, key):
+        self.by_tag = {}
+        self.universal = []
+        for position, rule in enumerate(sorted(rules, key=key)):
+            tag = rightmost_tag(rule[0])
+            if tag is None:
+                self.universal.append((position, rule))
+            else:
+                self.by_tag.setdefault(tag, []).append((position, rule))
+        # Tag bucket merged with the universal bucket, built on first use
+        self.merged = {}
+
+    def candidates(self, node) -> list:
+        if not isinstance(node, Element):
+            tag = None
+        else:
+            tag = node.tag
+        rules = self.merged.get(tag)
+        if rules is None:
+            entries = self.by_tag.get(tag, []) + self.universal
+            entries.sort(key=lambda entry: entry[0])
+            rules = [rule for _, rule in entries]
+            self.merged[tag] = rules
+        return rules
+
+
+class AncestorFilter:
+    """
+    Counting Bloom filter of the tags of the ancestors of the node being styled.
+    Tags are pushed and popped as style() walks down and back up the tree
+    """
+    BITS = 12
+    SIZE = 1 << BITS
+    MASK = SIZE - 1
+
+    def __init__(self):
+        self.counts = [0] * self.SIZE
+
+    @classmethod
+    def positions(cls, tag: str):
+        h = hash(tag)
+        return h & cls.MASK, (h >> cls.BITS) & cls.MASK
+
+    def push(self, tag: str):
+        first, second = self.positions(tag)
+        self.counts[first] += 1
+        self.counts[second] += 1
+
+    def pop(self, tag: str):
+        first, second = self.positions(tag)
+        self.counts[first] -= 1
+        self.counts[second] -= 1
+
+    def might_contain(self, tag: str) -> bool:
+        """False means no ancestor has this tag; True means one may have it"""
+        first, second = self.positions(tag)
+        return self.counts[first] > 0 and self.counts[second] > 0
+
+    def might_contain_all(self, tags: list) -> bool:
+        for tag in tags:
+            if not self.might_contain(tag):
+                return False
+        return True
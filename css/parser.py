@@ -6,7 +6,7 @@ class TagSelector:
         self.tag = tag
         self.priority = 1
 
-    def matches(self, node):
+    def matches(self, node, ancestors=None):
         return isinstance(node, Element) and self.tag == node.tag
 
 
@@ -15,10 +15,18 @@ class DescendantSelector:
         self.ancestor = ancestor
         self.descendant = descendant
         self.priority = ancestor.priority + descendant.priority
+        # Tags that must all appear among the node's ancestors
+        self.ancestor_tags = selector_tags(ancestor)
 
-    def matches(self, node):
+    def matches(self, node, ancestors=None):
+        """
+        :param ancestors: optional AncestorFilter of the node's ancestors, used to reject
+            the node without walking up the tree
+        """
         if not self.descendant.matches(node):
             return False
+        if ancestors is not None and not ancestors.might_contain_all(self.ancestor_tags):
+            return False
         while node.parent:
             if self.ancestor.matches(node.parent):
                 return True
@@ -26,6 +34,12 @@ class DescendantSelector:
         return False
 
 
+def selector_tags(selector) -> list:
+    if isinstance(selector, DescendantSelector):
+        return selector_tags(selector.ancestor) + selector_tags(selector.descendant)
+    return [selector.tag]
+
+
 class CSSParser:
     def __init__(self, s):
         self.s = s
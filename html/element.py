@@ -1,22 +1,130 @@
+import sys
+from types import MappingProxyType
+
+# Shared by every node without attributes / children, so those cost nothing per node
+EMPTY_ATTRIBUTES = MappingProxyType({})
+NO_CHILDREN = ()
+
+
 class Text:
+    __slots__ = ("_text", "parent", "style", "_words", "_prefix_widths")
+    children = NO_CHILDREN
+    # A text node is always restyled and laid out together with its parent
+    needs_style = False
+    child_needs_style = False
+    needs_layout = False
+    child_needs_layout = False
+
     def __init__(self, text, parent):
         self.text = text
-        self.children = []
         self.parent = parent
-        self.style = {}
+        self.style = None
+
+    @property
+    def text(self):
+        return self._text
+
+    @text.setter
+    def text(self, text):
+        self._text = text
+        # Segmentation and widths are computed on first layout
+        self._words = None
+        self._prefix_widths = None
+
+    @property
+    def words(self) -> list:
+        if self._words is None:
+            self._words = self._text.split()
+        return self._words
+
+    def prefix_widths(self, font_) -> list:
+        """
+        Cumulative widths of the words set in `font_`, each followed by a space:
+        entry k is the width of the first k words
+        """
+        if self._prefix_widths is None or self._prefix_widths[0] is not font_:
+            prefix = [0]
+            total = 0
+            space = font_.space_width
+            for word in self.words:
+                total += font_.measure(word) + space
+                prefix.append(total)
+            self._prefix_widths = (font_, prefix)
+        return self._prefix_widths[1]
 
     def __repr__(self):
         return repr(self.text)
 
 
 class Element:
+    __slots__ = ("tag", "attributes", "_children", "parent", "style", "is_focused",
+                 "needs_style", "child_needs_style", "needs_layout", "child_needs_layout")
+    # Selectors only match on tag names, so only the inline style can change a computed style
+    STYLE_ATTRIBUTES = ["style"]
+    # Attributes that are painted but don't change the layout
+    PAINT_ATTRIBUTES = ["value"]
+
     def __init__(self, tag: str, attributes: dict, parent):
-        self.tag = tag
-        self.attributes = attributes
-        self.children = []
+        self.tag = sys.intern(tag)
+        self.attributes = attributes or EMPTY_ATTRIBUTES
+        # The children list is only allocated when the first child is added
+        self._children = None
         self.parent = parent
-        self.style = {}
+        self.style = None
         self.is_focused = False
+        # Dirty bits: this subtree needs restyling / some subtree below does
+        self.needs_style = True
+        self.child_needs_style = False
+        # Same for layout
+        self.needs_layout = True
+        self.child_needs_layout = False
+
+    @property
+    def children(self):
+        return self._children if self._children is not None else NO_CHILDREN
+
+    def append_child(self, node):
+        if self._children is None:
+            self._children = [node]
+        else:
+            self._children.append(node)
+        # The child blocks laid out for this node no longer match its children
+        if not self.needs_layout:
+            self.invalidate_layout()
+
+    def extend_children(self, nodes: list):
+        for node in nodes:
+            self.append_child(node)
+
+    def pop_child(self):
+        if not self.needs_layout:
+            self.invalidate_layout()
+        return self._children.pop()
+
+    def set_attribute(self, name: str, value: str):
+        if self.attributes is EMPTY_ATTRIBUTES:
+            self.attributes = {}
+        self.attributes[sys.intern(name)] = value
+        if name in self.STYLE_ATTRIBUTES:
+            self.invalidate_style()
+        if name not in self.PAINT_ATTRIBUTES:
+            self.invalidate_layout()
+
+    def invalidate_style(self):
+        """Mark this subtree for restyling, and its ancestors as leading to it"""
+        self.needs_style = True
+        node = self.parent
+        while node is not None and not node.child_needs_style:
+            node.child_needs_style = True
+            node = node.parent
 
     def __repr__(self):
         return "<" + self.tag + ">"
+
+    def invalidate_layout(self):
+        """Mark this node for relayout, and its ancestors as leading to it"""
+        self.needs_layout = True
+        node = self.parent
+        while node is not None and not node.child_needs_layout:
+            node.child_needs_layout = True
+            node = node.parent
@@ -1,3 +1,6 @@
+import re
+import sys
+
 from html.element import Text, Element
 
 
@@ -14,64 +17,152 @@ class HTMLParser:
         "p", "li"
     ]
     VALID_FOLLOWER_SCRIPT_TAG = [" ", "\t", "\v", "\r", ">"]
+    DELIMITER = re.compile("[<>]")
+
+    # Insertion modes, named after the open elements they stand for
+    INITIAL = "initial"  # nothing open yet
+    IN_HTML = "in html"  # only <html> open
+    IN_HEAD = "in head"  # <html><head> open
+    IN_BODY = "in body"  # anything else
 
-    def __init__(self, body):
+    def __init__(self, body=""):
         self.body = body
         self.unfinished = []
+        # Number of open elements per tag name, to look up close tags in O(1)
+        self.open_tags = {}
+        self.insertion_mode = self.INITIAL
+
+        # Tokenizer state kept between feed() calls
+        self.text = ""
+        self.in_tag = False
+        self.in_script = False
+        self.pending = ""
+        self.script_search_from = 0
+        # Parents that snapshot() temporarily attached an open element to
+        self.attached = []
 
     def find_next_script_close_tag(self, i: int, b: str) -> (int, int):
         """
         Find position of the next </script> tag
         :param i: start position
         :param b: the content of html page
-        :return: start and end position of next </script> tag
+        :return: start and end position of next </script> tag, (-1, -1) if it has not arrived yet
         """
         cursor = i
         while True:
             potential = b.find("</script", cursor)
-            if potential == -1:
+            if potential == -1 or potential + 8 >= len(b):
                 return -1, -1
             elif b[potential + 8] in self.VALID_FOLLOWER_SCRIPT_TAG:
-                return potential, b.find(">", potential) + 1
+                end = b.find(">", potential)
+                if end == -1:
+                    return -1, -1
+                return potential, end + 1
             cursor = potential+1
 
     def parse(self):
-        text = ""
-        in_tag = False
-        b = self.body
+        self.feed(self.body)
+        return self.close()
+
+    def feed(self, data: str):
+        """
+        Parse the next piece of the document. Tokenizer and open element state is kept
+        so the document can be fed in arbitrary pieces
+        """
+        self._detach()
+        b = self.pending + data
+        self.pending = ""
         i = 0
-        while i < len(b):
-            if b[i] == "<":
-                in_tag = True
+        if self.in_script:
+            i = self._script_text(b, 0)
+            if i == -1:
+                return
+        text = self.text
+        find_delimiter = self.DELIMITER.search
+        while True:
+            # Slice the whole run up to the next "<" or ">" at once
+            match = find_delimiter(b, i)
+            if match is None:
+                text += b[i:]
+                break
+            j = match.start()
+            text += b[i:j]
+            i = j + 1
+            if b[j] == "<":
+                self.in_tag = True
                 if text:
                     self.add_text(text)
                 text = ""
-            elif b[i] == ">":
+            else:
+                self.in_tag = False
                 if text == "script":
-                    s, e = self.find_next_script_close_tag(i, b)
-                    self.add_tag("script")
-                    self.add_text(b[i+1:s])
-                    self.add_tag(b[s+1:e-1])
-                    i = e
                     text = ""
+                    self.add_tag("script")
+                    self.in_script = True
+                    self.script_search_from = 0
+                    i = self._script_text(b, i)
+                    if i == -1:
+                        self.text = ""
+                        return
                 else:
                     self.add_tag(text)
                     text = ""
-                in_tag = False
-            else:
-                text += b[i]
-            i += 1
-        if not in_tag and text:
-            self.add_text(text)
+        self.text = text
+
+    def _script_text(self, b: str, start: int) -> int:
+        """
+        Add the raw text of an open <script> and its close tag
+        :return: position after the close tag, -1 if the close tag has not arrived yet
+        """
+        s, e = self.find_next_script_close_tag(start + self.script_search_from, b)
+        if s == -1:
+            # Keep the unconsumed script text, and only rescan its tail next time
+            self.pending = b[start:]
+            self.script_search_from = max(len(self.pending) - 8, 0)
+            return -1
+        self.add_text(b[start:s])
+        self.add_tag(b[s+1:e-1])
+        self.in_script = False
+        self.script_search_from = 0
+        return e
+
+    def close(self):
+        """Finish parsing after the last piece has been fed and return the root node"""
+        self._detach()
+        if self.in_script:
+            # The close tag never came, everything left is script text
+            self.add_text(self.pending)
+            self.pending = ""
+            self.in_script = False
+        elif not self.in_tag and self.text:
+            self.add_text(self.text)
+        self.text = ""
         return self.finish()
 
+    def snapshot(self):
+        """
+        Return the root of the partially parsed document, with the still open elements
+        attached to their parents so it can be styled and laid out. They are detached
+        again on the next feed() or close()
+        """
+        self._detach()
+        for parent, node in zip(self.unfinished, self.unfinished[1:]):
+            parent.append_child(node)
+            self.attached.append(parent)
+        return self.unfinished[0] if self.unfinished else None
+
+    def _detach(self):
+        for parent in reversed(self.attached):
+            parent.pop_child()
+        self.attached = []
+
     def add_text(self, text: str):
         if text.isspace():
             return
         self.implicit_tags(None)
         parent = self.unfinished[-1]
         node = Text(text, parent)
-        parent.children.append(node)
+        parent.append_child(node)
 
     def add_tag(self, tag: str):
         tag, attributes = self.get_attributes(tag)
@@ -81,43 +172,84 @@ class HTMLParser:
         if tag.startswith("/"):
             if len(self.unfinished) == 1:
                 return
-            if tag[1:] in self.NO_NEST_TAG:
-                nodes = [self.unfinished.pop()]
-                while self.unfinished[-1].tag == tag[1:]:
-                    nodes.append(self.unfinished.pop())
-                parent = self.unfinished[-1]
-                parent.children += nodes
-            else:
-                # Check if the closing tag match
-                mismatch_tags = []
-                while self.unfinished[-1].tag != tag[1:]:
-                    mismatch_tags.append(self.unfinished[-1].tag)
-                    self.add_tag("/" + self.unfinished[-1].tag)
-
-                node = self.unfinished.pop()
-                parent = self.unfinished[-1]
-                parent.children.append(node)
-
-                # Reopen the mismatch tags
-                for tag in reversed(mismatch_tags):
-                    self.add_tag(tag)
+            self.close_tag(tag[1:])
         elif tag in self.SELF_CLOSING_TAGS:
             parent = self.unfinished[-1]
             node = Element(tag, attributes, parent)
-            parent.children.append(node)
+            parent.append_child(node)
         else:
             parent = self.unfinished[-1] if self.unfinished else None
             node = Element(tag, attributes, parent)
-            self.unfinished.append(node)
+            self.push(node)
+
+    def close_tag(self, tag: str):
+        """Close the innermost open element named `tag`"""
+        if tag in self.NO_NEST_TAG:
+            nodes = [self.pop()]
+            while self.unfinished[-1].tag == tag:
+                nodes.append(self.pop())
+            parent = self.unfinished[-1]
+            parent.extend_children(nodes)
+        elif self.open_tags.get(tag):
+            if self.unfinished[0].tag == tag and self.open_tags[tag] == 1:
+                # The root element, and everything still open in it, stays open until finish()
+                return
+            # Close the elements opened inside it, then reopen them after it
+            mismatch_tags = []
+            while self.unfinished[-1].tag != tag:
+                mismatch_tags.append(self.unfinished[-1].tag)
+                self.close_innermost()
+            self.close_innermost()
+            for name in reversed(mismatch_tags):
+                self.implicit_tags(name)
+                self.push(Element(name, {}, self.unfinished[-1]))
+        # Else it's a stray close tag without an open element, ignore it
+
+    def close_innermost(self):
+        """Close the innermost open element, with the run of same named elements under a <p> or <li>"""
+        tag = self.unfinished[-1].tag
+        nodes = [self.pop()]
+        if tag in self.NO_NEST_TAG:
+            while self.unfinished[-1].tag == tag:
+                nodes.append(self.pop())
+        parent = self.unfinished[-1]
+        parent.extend_children(nodes)
+
+    def push(self, node: Element):
+        self.unfinished.append(node)
+        self.open_tags[node.tag] = self.open_tags.get(node.tag, 0) + 1
+        if len(self.unfinished) <= 3:
+            self.update_insertion_mode()
+
+    def pop(self) -> Element:
+        node = self.unfinished.pop()
+        self.open_tags[node.tag] -= 1
+        if len(self.unfinished) <= 2:
+            self.update_insertion_mode()
+        return node
+
+    def update_insertion_mode(self):
+        """The insertion mode only depends on the bottom two open elements"""
+        depth = len(self.unfinished)
+        if depth > 2:
+            self.insertion_mode = self.IN_BODY
+        elif depth == 0:
+            self.insertion_mode = self.INITIAL
+        elif depth == 1 and self.unfinished[0].tag == "html":
+            self.insertion_mode = self.IN_HTML
+        elif depth == 2 and self.unfinished[0].tag == "html" and self.unfinished[1].tag == "head":
+            self.insertion_mode = self.IN_HEAD
+        else:
+            self.insertion_mode = self.IN_BODY
 
     def finish(self):
         if not self.unfinished:
             self.implicit_tags(None)
         while len(self.unfinished) > 1:
-            node = self.unfinished.pop()
+            node = self.pop()
             parent = self.unfinished[-1]
-            parent.children.append(node)
-        return self.unfinished.pop()
+            parent.append_child(node)
+        return self.pop()
 
     def get_attributes(self, text: str):
         parts = text.split()
@@ -128,24 +260,21 @@ class HTMLParser:
                 key, value = attrpair.split("=", 1)
                 if len(value) > 2 and value[0] in ["'", "\""]:
                     value = value[1:-1]
-                attributes[key.casefold()] = value
+                attributes[sys.intern(key.casefold())] = value
             else:
-                attributes[attrpair.casefold()] = ""
+                attributes[sys.intern(attrpair.casefold())] = ""
         return tag, attributes
 
     def implicit_tags(self, tag):
         while True:
-            open_tags = [node.tag for node in self.unfinished]
-            if open_tags == [] and tag != "html":
+            if self.insertion_mode == self.INITIAL and tag != "html":
                 self.add_tag("html")
-            elif open_tags == ["html"] and tag not in ["head", "body", "/html"]:
+            elif self.insertion_mode == self.IN_HTML and tag not in ["head", "body", "/html"]:
                 if tag in self.HEAD_TAGS:
                     self.add_tag("head")
                 else:
                     self.add_tag("body")
-            elif open_tags == ["html", "head"] and tag not in ["/head"] + self.HEAD_TAGS:
+            elif self.insertion_mode == self.IN_HEAD and tag != "/head" and tag not in self.HEAD_TAGS:
                 self.add_tag("/head")
             else:
                 break
-
-
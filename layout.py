@@ -1,4 +1,5 @@
 import tkinter
+from bisect import bisect_left, bisect_right
 
 from html.element import Text, Element
 from utils.fonts import get_font
@@ -30,12 +31,12 @@ class InputLayout:
         self.width = Config.INPUT_WIDTH_PX
 
         if self.previous:
-            space = self.previous.font.measure(" ")
+            space = self.previous.font.space_width
             self.x = self.previous.x + self.previous.width + space
         else:
             self.x = self.parent.x
 
-        self.height = self.font.metrics("linespace")
+        self.height = self.font.linespace
 
     def self_rect(self):
         return Rect(self.x, self.y, self.x + self.width, self.y + self.height)
@@ -43,14 +44,7 @@ class InputLayout:
     def should_paint(self):
         return True
 
-    def paint(self):
-        cmds = []
-        bgcolor = self.node.style.get("background-color",
-                                      "transparent")
-        if bgcolor != "transparent":
-            rect = DrawRect(self.self_rect(), bgcolor)
-            cmds.append(rect)
-
+    def text(self):
         text = ""
         if self.node.tag == "input":
             text = self.node.attributes.get("value", "")
@@ -60,6 +54,22 @@ class InputLayout:
             else:
                 print("Ignoring HTML contents inside button")
                 text = ""
+        return text
+
+    def paint_rect(self):
+        """The area paint() draws on, the text and cursor can go past the right edge"""
+        right = self.x + self.font.measure(self.text()) + 1
+        return Rect(self.x, self.y, max(self.x + self.width, right), self.y + self.height)
+
+    def paint(self):
+        cmds = []
+        bgcolor = self.node.style.get("background-color",
+                                      "transparent")
+        if bgcolor != "transparent":
+            rect = DrawRect(self.self_rect(), bgcolor)
+            cmds.append(rect)
+
+        text = self.text()
         color = self.node.style["color"]
         cmds.append(DrawText(self.x, self.y, text, self.font, color))
 
@@ -72,43 +82,47 @@ class InputLayout:
 
 
 class TextLayout:
-    def __init__(self, node, word, parent, previous):
+    """
+    A run of consecutive words on one line, from text of the same parent element and set in
+    the same font, so it is laid out and painted as a single piece of text
+    """
+
+    def __init__(self, node, words, font, width, parent, previous):
         self.node = node
-        self.word = word
+        self.words = words
         self.children = []
         self.parent = parent
         self.previous = previous
 
-        self.width = 0
+        self.width = width
         self.height = 0
         self.x = 0
         self.y = 0
-        self.font = None
+        self.font = font
 
-    def layout(self):
-        weight = self.node.style["font-weight"]
-        style = self.node.style["font-style"]
-        if style == "normal":
-            style = "roman"
-        size = int(float(self.node.style["font-size"][:-2]) * .75)
-        self.font = get_font(size, weight, style)
+    def can_extend(self, node, font) -> bool:
+        return (font is self.font and node.parent is self.node.parent
+                and node.style["color"] == self.node.style["color"])
 
-        self.width = self.font.measure(self.word)
+    def extend(self, words, width):
+        self.words.extend(words)
+        self.width += self.font.space_width + width
 
+    def layout(self):
         if self.previous:
-            space = self.previous.font.measure(" ")
+            space = self.previous.font.space_width
             self.x = self.previous.x + self.previous.width + space
         else:
             self.x = self.parent.x
 
-        self.height = self.font.metrics("linespace")
+        self.height = self.font.linespace
 
     def should_paint(self):
         return isinstance(self.node, Text) or (self.node.tag != "input" and self.node.tag != "button")
 
     def paint(self):
         color = self.node.style["color"]
-        return [DrawText(self.x, self.y, self.word, self.font, color)]
+        return [DrawText(self.x, self.y, " ".join(self.words), self.font, color)]
 
 
 class LineLayout:
@@ -137,11 +151,11 @@ class LineLayout:
             word.layout()
 
         if self.children:
-            max_ascent = max([word.font.metrics("ascent") for word in self.children])
+            max_ascent = max([word.font.ascent for word in self.children])
             baseline = self.y + 1.25 * max_ascent
             for word in self.children:
-                word.y = baseline - word.font.metrics("ascent")
-            max_descent = max([word.font.metrics("descent")
+                word.y = baseline - word.font.ascent
+            max_descent = max([word.font.descent
                                for word in self.children])
 
             self.height = 1.25 * (max_ascent + max_descent)
@@ -163,16 +177,30 @@ class DocumentLayout:
         self.y = 0
         self.width = None
         self.height = None
+        self.complete = False
 
-    def layout(self):
+    def layout(self, limit=None):
+        """
+        Lay out the document, or when `limit` is given only until the content reaches
+        past that y. Calling it again with a larger limit continues where it stopped
+        """
         self.width = Config.width - 2 * Config.HSTEP
         self.x = Config.HSTEP
         self.y = Config.VSTEP
 
-        child = BlockLayout(self.node, self, None)
-        self.children.append(child)
-        child.layout()
+        # The block tree is kept between layouts, see BlockLayout.layout
+        if not self.children:
+            self.children.append(BlockLayout(self.node, self, None))
+        child = self.children[0]
+        child.layout(limit)
         self.height = child.height
+        self.complete = child.complete
+
+    def estimated_height(self):
+        """The height of the whole document, estimated from the part laid out so far"""
+        if self.complete:
+            return self.height
+        return self.height / max(self.children[0].progress(), 0.001)
 
     def should_paint(self):
         return isinstance(self.node, Text) or (self.node.tag != "input" and self.node.tag != "button")
@@ -198,6 +226,10 @@ class BlockLayout:
         self.previous = previous
         self.children = []
 
+        # Child blocks not laid out yet by a layout with a limit, last one first
+        self.pending = []
+        self.complete = False
+
         self.x = 0
         self.y = 0
         self.width = None
@@ -231,49 +263,121 @@ class BlockLayout:
         else:
             return "block"
 
-    def layout(self):
-        self.x = self.parent.x
-        self.width = self.parent.width
-
+    def layout(self, limit=None):
+        """
+        Lay out this block. A block laid out before is only redone if its node or a
+        descendant was invalidated, or its width changed; otherwise it is at most moved.
+        With a `limit`, child blocks are only laid out until the content reaches past that
+        y, and a later call continues from there
+        """
+        x = self.parent.x
+        width = self.parent.width
         if self.previous:
-            self.y = self.previous.y + self.previous.height
+            y = self.previous.y + self.previous.height
         else:
-            self.y = self.parent.y
+            y = self.parent.y
+
+        dirty = self.node.needs_layout or self.node.child_needs_layout
+        unchanged = self.height is not None and not dirty and x == self.x and width == self.width
+        if unchanged and y != self.y:
+            shift_tree(self, y - self.y)
+        if unchanged and self.complete:
+            return
+
+        self.x = x
+        self.width = width
+        self.y = y
 
         mode = self.layout_mode()
         if mode == "block":
-            previous = None
-            for child in self.node.children:
-                next_ = BlockLayout(child, self, previous)
-                self.children.append(next_)
-                previous = next_
+            if self.node.needs_layout or self.height is None:
+                previous = None
+                blocks = []
+                for child in self.node.children:
+                    next_ = BlockLayout(child, self, previous)
+                    blocks.append(next_)
+                    previous = next_
+                self.children = []
+                self.pending = blocks[::-1]
+            elif unchanged:
+                # Continue from the block that was laid out last
+                if self.children and not self.children[-1].complete:
+                    self.pending.append(self.children.pop())
+            else:
+                # Child blocks are kept, and only redone where needed
+                self.pending.extend(reversed(self.children))
+                self.children = []
+            self.layout_children(limit)
         else:
+            self.children = []
             self.new_line()
             self.recurse(self.node)
-        for child in self.children:
-            child.layout()
+            for child in self.children:
+                child.layout()
+            self.complete = True
 
         self.height = sum([child.height for child in self.children])
-
-    def word(self, node, word):
+        if isinstance(self.node, Element):
+            self.node.needs_layout = False
+            self.node.child_needs_layout = False
+
+    def layout_children(self, limit):
+        while self.pending:
+            if limit is not None:
+                last = self.children[-1] if self.children else None
+                bottom = last.y + last.height if last else self.y
+                if bottom > limit:
+                    break
+            child = self.pending.pop()
+            child.layout(limit)
+            self.children.append(child)
+            if not child.complete:
+                break
+        self.complete = not self.pending and (not self.children or self.children[-1].complete)
+
+    def progress(self) -> float:
+        """Fraction of this block laid out so far, counted in child blocks"""
+        if self.complete:
+            return 1.0
+        done = len(self.children)
+        if self.children and not self.children[-1].complete:
+            done += self.children[-1].progress() - 1
+        return done / (len(self.children) + len(self.pending))
+
+    def text(self, node):
+        """
+        Lay out the words of a text node a line at a time: the words that still fit on
+        the current line are found by binary search over the node's cumulative word widths,
+        and become one run, or extend the run before them
+        """
         weight = node.style["font-weight"]
         style = node.style["font-style"]
         if style == "normal":
             style = "roman"
         size = int(float(node.style["font-size"][:-2]) * .75)
         font_ = get_font(size if not self.sup else int(size / 2), weight, style)
-        w = font_.measure(word)
-
-        if self.cursor_x + w > self.width:
-            self.new_line()
-
-        # self.line.append((self.cursor_x, word, font_, color, self.sup))
-        line = self.children[-1]
-        previous_word = line.children[-1] if line.children else None
-        text = TextLayout(node, word, line, previous_word)
-        line.children.append(text)
-
-        self.cursor_x += w + font_.measure(" ")
+        words = node.words
+        prefix = node.prefix_widths(font_)
+        space = font_.space_width
+
+        i = 0
+        while i < len(words):
+            # Word k fits if cursor_x + prefix[k + 1] - prefix[i] - space <= width
+            end = bisect_right(prefix, self.width - self.cursor_x + prefix[i] + space, i + 1) - 1
+            if end == i:
+                # Not even the next word fits: it goes on a new line, even if it is too wide
+                self.new_line()
+                end = i + 1
+            line = self.children[-1]
+            previous = line.children[-1] if line.children else None
+            # The words' widths with the spaces between them, but not the one after the last
+            width = prefix[end] - prefix[i] - space
+            if isinstance(previous, TextLayout) and previous.can_extend(node, font_):
+                previous.extend(words[i:end], width)
+            else:
+                line.children.append(TextLayout(node, words[i:end], font_, width, line, previous))
+            self.cursor_x += prefix[end] - prefix[i]
+            i = end
 
     def input(self, node):
         w = Config.INPUT_WIDTH_PX
@@ -291,7 +395,7 @@ class BlockLayout:
         size = int(float(node.style["font-size"][:-2]) * .75)
         font = get_font(size, weight, style)
 
-        self.cursor_x += w + font.measure(" ")
+        self.cursor_x += w + font.space_width
 
     def recurse(self, node):
         """
@@ -300,9 +404,11 @@ class BlockLayout:
         :return:
         """
         if isinstance(node, Text):
-            for word in node.text.split():
-                self.word(node, word)
+            self.text(node)
         else:
+            # Inline descendants are laid out as part of this block
+            node.needs_layout = False
+            node.child_needs_layout = False
             if node.tag == "br":
                 self.flush()
             elif node.tag == "input" or node.tag == "button":
@@ -320,21 +426,20 @@ class BlockLayout:
             center_offset = 0
 
         # Find the tallest word
-        metrics = [font_.metrics() for x, word, font_, color, sup in self.line]
-        max_ascent = max([metric["ascent"] for metric in metrics])
+        max_ascent = max([font_.ascent for x, word, font_, color, sup in self.line])
 
         # Calculate baseline based on tallest word than place each word relative to that line
         baseline = self.cursor_y + 1.25 * max_ascent
         for rel_x, word, font_, color, sup in self.line:
             x = self.x + rel_x
             if sup:
-                y = self.y + baseline - font_.metrics("ascent") * 2
+                y = self.y + baseline - font_.ascent * 2
             else:
-                y = self.y + baseline - font_.metrics("ascent")
+                y = self.y + baseline - font_.ascent
             self.display_list.append((x + center_offset, y, word, font_, color))
 
         # Move cursor_y far enough down below baseline to account for the deepest descender
-        max_descent = max([metric["descent"] for metric in metrics])
+        max_descent = max([font_.descent for x, word, font_, color, sup in self.line])
         self.cursor_y = baseline + 1.25 * max_descent
 
         self.cursor_x = 0
@@ -360,6 +465,15 @@ class BlockLayout:
         return cmds
 
 
+def shift_tree(layout_object, dy):
+    """Move a laid out subtree vertically without laying it out again"""
+    stack = [layout_object]
+    while stack:
+        obj = stack.pop()
+        obj.y += dy
+        stack.extend(obj.children)
+
+
 class DrawText:
     def __init__(self, x1, y1, text, font, color):
         self.top = y1
@@ -367,15 +481,19 @@ class DrawText:
         self.text = text
         self.font = font
         self.color = color
-        self.bottom = y1 + font.metrics("linespace")
+        self.bottom = y1 + font.linespace
+
+    def bounds(self):
+        return Rect(self.left, self.top, self.left + self.font.measure(self.text), self.bottom)
 
-    def execute(self, scroll, canvas):
-        canvas.create_text(
+    def execute(self, scroll, canvas, tags=()):
+        return canvas.create_text(
             self.left, self.top - scroll,
             text=self.text,
-            font=self.font,
+            font=self.font.tk_font,
             fill=self.color,
-            anchor='nw'
+            anchor='nw',
+            tags=tags
         )
 
 
@@ -387,26 +505,36 @@ class DrawRect:
         self.bottom = rect.bottom
         self.color = color
 
-    def execute(self, scroll, canvas):
-        canvas.create_rectangle(
+    def bounds(self):
+        return Rect(self.left, self.top, self.right, self.bottom)
+
+    def execute(self, scroll, canvas, tags=()):
+        return canvas.create_rectangle(
             self.left, self.top - scroll,
             self.right, self.bottom - scroll,
             width=0,
-            fill=self.color)
+            fill=self.color,
+            tags=tags)
 
 
 class DrawOutline:
     def __init__(self, rect, color, thickness):
+        self.top = rect.top
+        self.bottom = rect.bottom
         self.rect = rect
         self.color = color
         self.thickness = thickness
 
-    def execute(self, scroll, canvas):
-        canvas.create_rectangle(
+    def bounds(self):
+        return self.rect
+
+    def execute(self, scroll, canvas, tags=()):
+        return canvas.create_rectangle(
             self.rect.left, self.rect.top - scroll,
             self.rect.right, self.rect.bottom - scroll,
             width=self.thickness,
-            outline=self.color)
+            outline=self.color,
+            tags=tags)
 
 
 class DrawLine:
@@ -417,8 +545,80 @@ class DrawLine:
         self.color = color
         self.thickness = thickness
 
-    def execute(self, scroll, canvas: tkinter.Canvas):
-        canvas.create_line(
+    def bounds(self):
+        return self.rect
+
+    def execute(self, scroll, canvas: tkinter.Canvas, tags=()):
+        return canvas.create_line(
             self.rect.left, self.rect.top - scroll,
             self.rect.right, self.rect.bottom - scroll,
-            fill=self.color, width=self.thickness)
+            fill=self.color, width=self.thickness, tags=tags)
+
+
+class DisplayListIndex:
+    """
+    The commands of a display list sorted by top, to find the ones overlapping a range of y
+    by binary search. Commands taller than TALL_COMMAND are checked one by one instead, so
+    that they don't widen every search
+    """
+    TALL_COMMAND = 1000
+
+    def __init__(self, display_list: list):
+        self.display_list = display_list
+        short = []
+        self.tall = []
+        for i, cmd in enumerate(display_list):
+            if cmd.bottom - cmd.top > self.TALL_COMMAND:
+                self.tall.append(i)
+            else:
+                short.append((cmd.top, i))
+        short.sort()
+        self.tops = [top for top, i in short]
+        self.short = [i for top, i in short]
+        self.max_height = max([display_list[i].bottom - display_list[i].top for i in self.short], default=0)
+
+    def query(self, top, bottom) -> list:
+        """The commands overlapping top..bottom, in paint order"""
+        return [self.display_list[i] for i in self.positions(top, bottom)]
+
+    def positions(self, top, bottom) -> list:
+        """Positions in the display list of the commands overlapping top..bottom, in order"""
+        display_list = self.display_list
+        start = bisect_left(self.tops, top - self.max_height)
+        end = bisect_right(self.tops, bottom)
+        hits = [i for i in self.short[start:end] if display_list[i].bottom >= top]
+        hits.extend(i for i in self.tall
+                    if display_list[i].top <= bottom and display_list[i].bottom >= top)
+        hits.sort()
+        return hits
+
+
+class HitTestIndex:
+    """
+    Laid out boxes bucketed into bands of BAND_HEIGHT pixels of the page, to find the boxes
+    under a point by only looking at the boxes crossing its band. Boxes are added in tree
+    order while the tree is painted, so a band lists a box after its ancestors
+    """
+    BAND_HEIGHT = 64
+
+    def __init__(self):
+        # Band -> layout objects crossing it, in tree order
+        self.bands = {}
+
+    def add(self, obj):
+        if not obj.height:
+            return
+        first = int(obj.y // self.BAND_HEIGHT)
+        last = int((obj.y + obj.height) // self.BAND_HEIGHT)
+        for band in range(first, last + 1):
+            self.bands.setdefault(band, []).append(obj)
+
+    def hits(self, x, y) -> list:
+        """The boxes containing (x, y), in tree order"""
+        return [obj for obj in self.bands.get(int(y // self.BAND_HEIGHT), [])
+                if obj.x <= x < obj.x + obj.width and obj.y <= y < obj.y + obj.height]
+
+    def hit_test(self, x, y):
+        """The deepest box containing (x, y), the last one in tree order, or None"""
+        hits = self.hits(x, y)
+        return hits[-1] if hits else None
@@ -0,0 +1,65 @@
+import queue
+import tkinter
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from utils.config import Config
+
+
+class PageLoader:
+    """
+    Runs page loads on worker threads. Workers hand results back with post(), and the Tk
+    thread runs them when it polls the queue, so the DOM, layout and canvas are only ever
+    touched from the Tk thread
+    """
+    POLL_INTERVAL_MS = 16
+
+    def __init__(self, window: tkinter.Misc):
+        self.window = window
+        self.executor = ThreadPoolExecutor(max_workers=Config.LOADER_THREADS, thread_name_prefix="loader")
+        self.results = queue.Queue()
+        self.running = 0
+        self.polling = False
+
+    def submit(self, function, *args):
+        """Run `function(*args)` on a worker thread"""
+        self.running += 1
+        self.executor.submit(self._run, function, *args)
+        if not self.polling:
+            self.polling = True
+            self.window.after(self.POLL_INTERVAL_MS, self.poll)
+
+    def shutdown(self):
+        """Drop queued loads and stop polling. Loads already running stop on their own"""
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.running = 0
+
+    def post(self, function, *args):
+        """Run `function(*args)` on the Tk thread. Can be called from any thread"""
+        self.results.put((function, args))
+
+    def _run(self, function, *args):
+        try:
+            function(*args)
+        except Exception:
+            traceback.print_exc()
+        finally:
+            self.post(self._done)
+
+    def _done(self):
+        self.running -= 1
+
+    def poll(self):
+        while True:
+            try:
+                function, args = self.results.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                function(*args)
+            except Exception:
+                traceback.print_exc()
+        if self.running > 0:
+            self.window.after(self.POLL_INTERVAL_MS, self.poll)
+        else:
+            self.polling = False
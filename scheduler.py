@@ -0,0 +1,62 @@
+import time
+import tkinter
+from collections import deque
+
+from utils.config import Config
+
+
+class FrameStats:
+    """Durations of the most recent frames, in seconds"""
+    KEEP = 240
+
+    def __init__(self):
+        self.count = 0
+        self.recent = deque(maxlen=self.KEEP)
+
+    def record(self, duration: float):
+        self.count += 1
+        self.recent.append(duration)
+
+    def mean(self) -> float:
+        return sum(self.recent) / len(self.recent) if self.recent else 0.0
+
+    def percentile(self, fraction: float) -> float:
+        if not self.recent:
+            return 0.0
+        durations = sorted(self.recent)
+        return durations[min(int(fraction * len(durations)), len(durations) - 1)]
+
+    def __repr__(self):
+        return "{} frames, mean {:.1f}ms, p95 {:.1f}ms, max {:.1f}ms".format(
+            self.count, self.mean() * 1000, self.percentile(0.95) * 1000, max(self.recent, default=0) * 1000)
+
+
+class FrameScheduler:
+    """
+    Runs `frame` at most once every 1 / Config.FRAME_RATE seconds. Events only ask for a
+    frame, so any number of them before the next frame are handled by that one frame
+    """
+
+    def __init__(self, window: tkinter.Misc, frame):
+        self.window = window
+        self.frame = frame
+        self.interval = 1 / Config.FRAME_RATE
+        self.scheduled = False
+        self.last_start = 0
+        self.stats = FrameStats()
+
+    def schedule(self):
+        if self.scheduled:
+            return
+        self.scheduled = True
+        wait = self.last_start + self.interval - time.perf_counter()
+        if wait > 0:
+            self.window.after(int(wait * 1000) + 1, self.run)
+        else:
+            self.window.after_idle(self.run)
+
+    def run(self):
+        self.scheduled = False
+        self.last_start = time.perf_counter()
+        self.frame()
+        self.stats.record(time.perf_counter() - self.last_start)
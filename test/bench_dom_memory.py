@@ -0,0 +1,84 @@
+"""
+Memory per DOM node for a 100k-node document, against the previous plain classes
+with a __dict__, fresh attribute/style dicts and children lists on every node.
+
+Run from the repository root: python -m test.bench_dom_memory [nodes]
+"""
+import gc
+import sys
+import tracemalloc
+
+import html.parser
+from html.element import Element, Text
+
+
+class DictText:
+    def __init__(self, text, parent):
+        self.text = text
+        self.children = []
+        self.parent = parent
+        self.style = {}
+
+
+class DictElement:
+    def __init__(self, tag: str, attributes: dict, parent):
+        self.tag = tag
+        self.attributes = attributes
+        self.children = []
+        self.parent = parent
+        self.style = {}
+        self.is_focused = False
+
+    def append_child(self, node):
+        self.children.append(node)
+
+    def extend_children(self, nodes: list):
+        self.children += nodes
+
+    def pop_child(self):
+        return self.children.pop()
+
+
+def make_document(nodes: int) -> str:
+    # Each item is 4 nodes: <li>, its text, <a> and its text
+    item = "<li class=\"entry\"><a href=\"/page.html\">link text</a> trailing text</li>"
+    return "<ul>" + item * (nodes // 4) + "</ul>"
+
+
+def count_nodes(root) -> int:
+    count = 0
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        count += 1
+        stack.extend(node.children)
+    return count
+
+
+def measure(element_class, text_class, document: str):
+    html.parser.Element, html.parser.Text = element_class, text_class
+    try:
+        gc.collect()
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        parser = html.parser.HTMLParser(document)
+        tree = parser.parse()
+        del parser
+        gc.collect()
+        used = tracemalloc.get_traced_memory()[0] - before
+        tracemalloc.stop()
+    finally:
+        html.parser.Element, html.parser.Text = Element, Text
+    return used, count_nodes(tree)
+
+
+if __name__ == "__main__":
+    nodes = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    document = make_document(nodes)
+    old_bytes, old_nodes = measure(DictElement, DictText, document)
+    new_bytes, new_nodes = measure(Element, Text, document)
+    assert old_nodes == new_nodes
+    print("nodes:        {}".format(new_nodes))
+    print("plain classes: {:.1f} bytes/node".format(old_bytes / old_nodes))
+    print("compact:       {:.1f} bytes/node".format(new_bytes / new_nodes))
+    print("saving:        {:.0%}".format(1 - new_bytes / old_bytes))
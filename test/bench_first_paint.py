@@ -0,0 +1,91 @@
+"""
+Time to first paint of a long page with lazy layout, against laying out the whole page.
+Text is measured with the glyph table backend: tables from Config.GLYPH_CACHE_FILE when
+they have been measured, approximate widths otherwise, so this runs without a display.
+
+Run from the repository root: python -m test.bench_first_paint [megabytes]
+"""
+import gc
+import random
+import sys
+import time
+
+from browser import Tab, restyle
+from html.parser import HTMLParser
+from utils.config import Config
+from utils.fonts import set_metrics_backend
+from utils.metrics import GlyphTable, GlyphTableMetrics
+
+WORDS = ["the", "browser", "lays", "out", "text", "in", "lines", "of", "words", "paragraph",
+         "a", "performance", "is", "measured", "when", "page", "very", "long", "and"]
+
+
+class ApproximateMetrics(GlyphTableMetrics):
+    """Made-up tables for fonts that were never measured, when there is no Tk to do it"""
+
+    def table(self, font_):
+        if font_.key not in self.tables and font_.key not in self.latest:
+            size, weight, style = font_.key
+            width = round(size * (0.66 if weight == "bold" else 0.6))
+            widths = {char: width for char in GlyphTable.CHARACTERS}
+            self.tables[font_.key] = GlyphTable(size, size // 4, size + size // 4, widths)
+        return super().table(font_)
+
+
+def make_document(size: int, rng: random.Random) -> str:
+    parts = []
+    length = 0
+    section = 0
+    while length < size:
+        section += 1
+        paragraphs = []
+        for _ in range(10):
+            words = [rng.choice(WORDS) for _ in range(rng.randint(20, 80))]
+            words[rng.randrange(len(words))] = "<b>{}</b>".format(rng.choice(WORDS))
+            paragraphs.append("<p>{}</p>".format(" ".join(words)))
+        part = "<div><h2>Section {}</h2>{}</div>".format(section, "".join(paragraphs))
+        parts.append(part)
+        length += len(part)
+    return "<html><body>" + "".join(parts) + "</body></html>"
+
+
+def first_paint(html: str, lazy: bool) -> list:
+    """Parse, style, and lay out and paint the first screen, returning each phase's time"""
+    Config.LAZY_LAYOUT = lazy
+    gc.collect()
+    start = time.perf_counter()
+    nodes = HTMLParser(html).parse()
+    parsed = time.perf_counter()
+    tab = Tab(Config.height)
+    tab.nodes = nodes
+    restyle(nodes, tab.rule_index)
+    styled = time.perf_counter()
+    tab.render()
+    painted = time.perf_counter()
+    return [parsed - start, styled - parsed, painted - styled], tab
+
+
+if __name__ == "__main__":
+    megabytes = float(sys.argv[1]) if len(sys.argv) > 1 else 5
+    set_metrics_backend(ApproximateMetrics(Config.GLYPH_CACHE_FILE))
+    html = make_document(int(megabytes * 1024 * 1024), random.Random(0))
+
+    # Warm up the font tables and width cache, both modes share them
+    first_paint(html[:100000] + "</body></html>", False)
+
+    (parse, style_, full_layout), full_tab = first_paint(html, lazy=False)
+    (_, _, lazy_layout), lazy_tab = first_paint(html, lazy=True)
+    start = time.perf_counter()
+    lazy_tab.scrolldown(None, Config.height)
+    scroll = time.perf_counter() - start
+
+    print("{:.1f} MB, {} display commands".format(len(html) / 1024 / 1024, len(full_tab.display_list)))
+    print("parse:               {:.3f}s".format(parse))
+    print("style:               {:.3f}s".format(style_))
+    print("full layout + paint: {:.3f}s".format(full_layout))
+    print("lazy layout + paint: {:.3f}s".format(lazy_layout))
+    print("first paint:         {:.3f}s full, {:.3f}s lazy".format(parse + style_ + full_layout,
+                                                                  parse + style_ + lazy_layout))
+    print("scroll a screen:     {:.3f}s lazy".format(scroll))
+    print("estimated height:    {:.0f}px, actual {:.0f}px".format(lazy_tab.document.estimated_height(),
+                                                                 full_tab.document.height))
@@ -0,0 +1,118 @@
+"""
+Throughput of HTMLParser.parse against the previous character-by-character tokenizer, on a
+markup-dense and a text-heavy document. Bulk scanning pays off on long runs of text, on
+markup-dense pages tree building dominates and the two are about even.
+
+Run from the repository root: python -m test.bench_parser [size in MB]
+"""
+import gc
+import sys
+import time
+
+from html.element import Element
+from html.parser import HTMLParser
+
+
+class CharByCharHTMLParser(HTMLParser):
+    """The tokenizer as it was before bulk scanning, kept for comparison"""
+
+    def feed(self, data: str):
+        self._detach()
+        b = self.pending + data
+        self.pending = ""
+        i = 0
+        if self.in_script:
+            i = self._script_text(b, 0)
+            if i == -1:
+                return
+        text = self.text
+        while i < len(b):
+            if b[i] == "<":
+                self.in_tag = True
+                if text:
+                    self.add_text(text)
+                text = ""
+            elif b[i] == ">":
+                self.in_tag = False
+                if text == "script":
+                    text = ""
+                    self.add_tag("script")
+                    self.in_script = True
+                    self.script_search_from = 0
+                    i = self._script_text(b, i + 1)
+                    if i == -1:
+                        self.text = ""
+                        return
+                    continue
+                else:
+                    self.add_tag(text)
+                    text = ""
+            else:
+                text += b[i]
+            i += 1
+        self.text = text
+
+
+MARKUP_SECTION = (
+    "<div class=\"section\"><h2 id=\"title\">A heading for this section</h2>\n"
+    "<p>Some <b>bold</b> and <i>italic</i> text with a <a href=\"/link.html\">link</a> "
+    "in a paragraph that is long enough to wrap over several lines of the page.</p>\n"
+    "<ul><li>First item</li><li>Second item</li><li>Third <em>item</em></li></ul>\n"
+    "<script>var x = 1 < 2 && 3 > 2;</script>\n"
+    "<p>Form: <input name=q value=abc> <button>Go</button></p></div>\n"
+)
+# Long paragraphs of prose, like an article or a book chapter
+TEXT_SECTION = (
+    "<h2>A chapter heading</h2>\n<p>"
+    + "The browser reads the page from the network and turns the text into a tree of "
+      "elements, which is then styled, laid out into lines and painted on the screen. " * 25
+    + "</p>\n"
+)
+SHAPES = {
+    "markup-dense": MARKUP_SECTION,
+    "text-heavy": TEXT_SECTION,
+}
+
+
+def make_document(size: int, section: str = MARKUP_SECTION) -> str:
+    body = section * (size // len(section) + 1)
+    return "<!DOCTYPE html><html><head><title>Bench</title></head><body>" + body + "</body></html>"
+
+
+def tree_signature(node, out):
+    if isinstance(node, Element):
+        out.append((node.tag, sorted(node.attributes.items())))
+    else:
+        out.append(node.text)
+    for child in node.children:
+        tree_signature(child, out)
+    return out
+
+
+def bench(parser_class, document: str, repeat: int = 3):
+    best = None
+    signature = None
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        tree = parser_class(document).parse()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+        signature = tree_signature(tree, [])
+    return best, signature
+
+
+if __name__ == "__main__":
+    size_mb = float(sys.argv[1]) if len(sys.argv) > 1 else 2
+    for name, section in SHAPES.items():
+        document = make_document(int(size_mb * 1024 * 1024), section)
+        mb = len(document.encode("utf8")) / (1024 * 1024)
+
+        old_time, old_tree = bench(CharByCharHTMLParser, document)
+        new_time, new_tree = bench(HTMLParser, document)
+        assert old_tree == new_tree, name + ": trees differ"
+
+        print("{} document: {:.2f} MB".format(name, mb))
+        print("  char by char: {:.3f}s  {:.2f} MB/s".format(old_time, mb / old_time))
+        print("  bulk:         {:.3f}s  {:.2f} MB/s".format(new_time, mb / new_time))
+        print("  speedup:      {:.2f}x".format(old_time / new_time))
@@ -0,0 +1,112 @@
+"""
+Tree building on adversarial markup, against the previous add_tag/implicit_tags that
+rebuilt the list of open tag names on every token.
+
+Run from the repository root: python -m test.bench_parser_adversarial [count]
+"""
+import gc
+import sys
+import time
+
+from html.element import Element
+from html.parser import HTMLParser
+
+
+class ListScanHTMLParser(HTMLParser):
+    """The tree builder as it was before insertion modes, kept for comparison"""
+
+    def add_tag(self, tag: str):
+        tag, attributes = self.get_attributes(tag)
+        if tag.startswith("!"):
+            return
+        self.implicit_tags(tag)
+        if tag.startswith("/"):
+            if len(self.unfinished) == 1:
+                return
+            if tag[1:] in self.NO_NEST_TAG:
+                nodes = [self.unfinished.pop()]
+                while self.unfinished[-1].tag == tag[1:]:
+                    nodes.append(self.unfinished.pop())
+                parent = self.unfinished[-1]
+                parent.extend_children(nodes)
+            else:
+                mismatch_tags = []
+                while self.unfinished[-1].tag != tag[1:]:
+                    mismatch_tags.append(self.unfinished[-1].tag)
+                    self.add_tag("/" + self.unfinished[-1].tag)
+
+                node = self.unfinished.pop()
+                parent = self.unfinished[-1]
+                parent.append_child(node)
+
+                for tag in reversed(mismatch_tags):
+                    self.add_tag(tag)
+        elif tag in self.SELF_CLOSING_TAGS:
+            parent = self.unfinished[-1]
+            node = Element(tag, attributes, parent)
+            parent.append_child(node)
+        else:
+            parent = self.unfinished[-1] if self.unfinished else None
+            node = Element(tag, attributes, parent)
+            self.unfinished.append(node)
+
+    def finish(self):
+        if not self.unfinished:
+            self.implicit_tags(None)
+        while len(self.unfinished) > 1:
+            node = self.unfinished.pop()
+            parent = self.unfinished[-1]
+            parent.append_child(node)
+        return self.unfinished.pop()
+
+    def implicit_tags(self, tag):
+        while True:
+            open_tags = [node.tag for node in self.unfinished]
+            if open_tags == [] and tag != "html":
+                self.add_tag("html")
+            elif open_tags == ["html"] and tag not in ["head", "body", "/html"]:
+                if tag in self.HEAD_TAGS:
+                    self.add_tag("head")
+                else:
+                    self.add_tag("body")
+            elif open_tags == ["html", "head"] and tag not in ["/head"] + self.HEAD_TAGS:
+                self.add_tag("/head")
+            else:
+                break
+
+
+def tree_signature(root):
+    # Iterative, the unclosed <div> case is too deep to recurse
+    out = []
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        out.append(getattr(node, "tag", None) or node.text)
+        stack.extend(reversed(node.children))
+    return out
+
+
+CASES = {
+    "unclosed <div>": lambda n: "<div>x" * n,
+    "<b><i> misnesting": lambda n: "<b>1<i>2</b>3</i>" * n,
+    "nested misnesting": lambda n: "<div>" * 100 + "<b>1<i>2</b>3</i>" * n,
+    "unclosed <p>": lambda n: "<p>x" * n,
+}
+
+
+def bench(parser_class, document: str):
+    gc.collect()
+    start = time.perf_counter()
+    tree = parser_class(document).parse()
+    return time.perf_counter() - start, tree_signature(tree)
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    for name, make in CASES.items():
+        document = make(count)
+        old_time, old_tree = bench(ListScanHTMLParser, document)
+        new_time, new_tree = bench(HTMLParser, document)
+        assert old_tree == new_tree, name + ": trees differ"
+        print("{:<20} list scan: {:.3f}s  insertion mode: {:.3f}s  speedup: {:.1f}x".format(
+            name, old_time, new_time, old_time / new_time))
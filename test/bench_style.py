@@ -0,0 +1,105 @@
+"""
+style() with the rule index against testing every rule on every node.
+
+Run from the repository root: python -m test.bench_style [rules] [nodes]
+"""
+import gc
+import random
+import sys
+import time
+
+from browser import DEFAULT_STYLE_SHEET, cascade_priority, style
+from css.cascade import RuleIndex
+from css.parser import CSSParser
+from html.element import Element
+from html.parser import HTMLParser
+from utils.config import Config
+
+TAGS = ["div", "span", "a", "b", "i", "em", "ul", "ol", "h1", "h2", "section",
+        "article", "nav", "small", "big", "code", "pre", "td", "tr", "table"]
+
+
+def style_all_rules(node, rules: list):
+    """The cascade as it was before the rule index"""
+    node.style = {}
+    for property_, default_value in Config.INHERITED_PROPERTIES.items():
+        if node.parent:
+            node.style[property_] = node.parent.style[property_]
+        else:
+            node.style[property_] = default_value
+
+    for selector, body in rules:
+        if not selector.matches(node):
+            continue
+        for property_, value in body.items():
+            node.style[property_] = value
+
+    if isinstance(node, Element) and "style" in node.attributes:
+        pairs = CSSParser(node.attributes["style"]).body()
+        for property_, value in pairs.items():
+            node.style[property_] = value
+
+    if node.style["font-size"].endswith("%"):
+        if node.parent:
+            parent_font_size = node.parent.style["font-size"]
+        else:
+            parent_font_size = Config.INHERITED_PROPERTIES["font-size"]
+        node_pct = float(node.style["font-size"][:-1]) / 100
+        parent_px = float(parent_font_size[:-2])
+        node.style["font-size"] = str(node_pct * parent_px) + "px"
+
+    for child in node.children:
+        style_all_rules(child, rules)
+
+
+def make_rules(count: int, rng: random.Random) -> list:
+    sheet = []
+    for i in range(count):
+        selector = " ".join(rng.choice(TAGS) for _ in range(rng.choice([1, 1, 2, 3])))
+        sheet.append("{} {{ color: c{}; }}".format(selector, i))
+    return DEFAULT_STYLE_SHEET + CSSParser("\n".join(sheet)).parse()
+
+
+def make_document(nodes: int, rng: random.Random) -> str:
+    parts = []
+    made = 0
+    while made < nodes:
+        outer, inner = rng.choice(TAGS), rng.choice(TAGS)
+        parts.append("<{0}><{1}>text</{1}> more text</{0}>".format(outer, inner))
+        made += 4
+    return "<div>" + "".join(parts) + "</div>"
+
+
+def computed_styles(root) -> list:
+    out = []
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        out.append(tuple(sorted(node.style.items())))
+        stack.extend(node.children)
+    return out
+
+
+def timed(function, *args):
+    gc.collect()
+    start = time.perf_counter()
+    function(*args)
+    return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    rule_count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    node_count = int(sys.argv[2]) if len(sys.argv) > 2 else 50000
+    rng = random.Random(0)
+    rules = make_rules(rule_count, rng)
+    root = HTMLParser(make_document(node_count, rng)).parse()
+
+    old_time = timed(lambda: style_all_rules(root, sorted(rules, key=cascade_priority)))
+    old_styles = computed_styles(root)
+    new_time = timed(lambda: style(root, RuleIndex(rules, cascade_priority)))
+    assert computed_styles(root) == old_styles, "computed styles differ"
+
+    print("{} rules x {} nodes".format(len(rules), len(old_styles)))
+    print("all rules:  {:.3f}s".format(old_time))
+    print("rule index: {:.3f}s".format(new_time))
+    print("speedup:    {:.1f}x".format(old_time / new_time))
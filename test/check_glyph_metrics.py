@@ -0,0 +1,73 @@
+"""
+Compare widths from the glyph table backend against Tk on a word corpus, and time both.
+Needs a display. Builds (and saves) the glyph tables it is missing.
+
+Run from the repository root: python -m test.check_glyph_metrics [file ...]
+"""
+import random
+import sys
+import time
+import tkinter
+
+from utils.config import Config
+from utils.fonts import get_font, set_metrics_backend
+from utils.metrics import GlyphTableMetrics
+
+SIZES = [6, 9, 12, 18, 24]
+WEIGHTS = ["normal", "bold"]
+STYLES = ["roman", "italic"]
+
+# A word may be off by this many pixels, or by this fraction of its width if larger
+TOLERANCE_PX = 2
+TOLERANCE_FRACTION = 0.03
+
+
+def make_corpus(paths: list, rng: random.Random) -> list:
+    words = []
+    for path in paths:
+        with open(path, encoding="utf8") as f:
+            words.extend(f.read().split())
+    letters = "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789.,;:!?'\"()-éüßñ"
+    for _ in range(5000):
+        words.append("".join(rng.choice(letters) for _ in range(rng.randint(1, 14))))
+    return words
+
+
+def timed(function):
+    start = time.perf_counter()
+    function()
+    return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    root = tkinter.Tk()
+    root.withdraw()
+    corpus = make_corpus(sys.argv[1:], random.Random(0))
+    backend = GlyphTableMetrics(Config.GLYPH_CACHE_FILE, root)
+    set_metrics_backend(backend)
+
+    failures = 0
+    worst = 0
+    tk_time = table_time = 0
+    for size in SIZES:
+        for weight in WEIGHTS:
+            for style in STYLES:
+                font_ = get_font(size, weight, style)
+                table = backend.table(font_)
+                tk_widths = []
+                table_widths = []
+                tk_time += timed(lambda: tk_widths.extend(font_.tk_font.measure(w) for w in corpus))
+                table_time += timed(lambda: table_widths.extend(table.measure(w) for w in corpus))
+                for word, expected, actual in zip(corpus, tk_widths, table_widths):
+                    error = abs(expected - actual)
+                    worst = max(worst, error)
+                    if error > max(TOLERANCE_PX, TOLERANCE_FRACTION * expected):
+                        failures += 1
+                        print("{} {!r}: tk {} table {}".format(font_.key, word, expected, actual))
+    backend.save()
+
+    measured = len(corpus) * len(SIZES) * len(WEIGHTS) * len(STYLES)
+    print("{} measurements, {} outside tolerance, worst error {}px".format(measured, failures, worst))
+    print("tk:    {:.3f}s".format(tk_time))
+    print("table: {:.3f}s".format(table_time))
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,169 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+class CacheEntry:
+    def __init__(self, body: str, etag=None, last_modified=None, expires=0.0):
+        self.body = body
+        self.etag = etag
+        self.last_modified = last_modified
+        self.expires = expires
+        self.size = len(body.encode("utf8"))
+
+    def is_fresh(self) -> bool:
+        return time.time() < self.expires
+
+    def validators(self) -> dict:
+        """Headers for a conditional request revalidating this entry"""
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+    def to_json(self) -> dict:
+        return {
+            "body": self.body,
+            "etag": self.etag,
+            "last_modified": self.last_modified,
+            "expires": self.expires,
+        }
+
+
+def parse_cache_control(value: str) -> dict:
+    """Parse `Cache-Control: no-store, max-age=60` into {"no-store": None, "max-age": "60"}"""
+    directives = {}
+    for part in value.split(","):
+        part = part.strip().casefold()
+        if not part:
+            continue
+        if "=" in part:
+            key, arg = part.split("=", 1)
+            directives[key.strip()] = arg.strip().strip("\"")
+        else:
+            directives[part] = None
+    return directives
+
+
+def freshness_lifetime(headers: dict) -> float:
+    """Number of seconds a response may be reused without revalidation"""
+    directives = parse_cache_control(headers.get("cache-control", ""))
+    if "no-cache" in directives:
+        return 0
+    try:
+        return max(int(directives.get("max-age", 0)), 0)
+    except ValueError:
+        return 0
+
+
+class ResponseCache:
+    """
+    HTTP response cache: an in-memory LRU tier bounded by body bytes, backed by an
+    optional on-disk tier with one file per URL
+    """
+
+    def __init__(self, max_bytes: int, directory=None):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.entries = OrderedDict()
+        self.size = 0
+        # Keeps the LRU order of `entries` and the byte count in `size` consistent across
+        # loader threads. Reentrant because store() calls remove()
+        self.lock = threading.RLock()
+
+    def get(self, url: str):
+        with self.lock:
+            entry = self.entries.get(url)
+            if entry is not None:
+                self.entries.move_to_end(url)
+                return entry
+            entry = self._read_disk(url)
+            if entry is not None:
+                self._put_memory(url, entry)
+            return entry
+
+    @staticmethod
+    def is_storable(headers: dict) -> bool:
+        """Whether a 200 response with these headers may be stored and reused"""
+        directives = parse_cache_control(headers.get("cache-control", ""))
+        if "no-store" in directives:
+            return False
+        # Neither fresh nor revalidatable: caching would never pay off
+        return (freshness_lifetime(headers) > 0
+                or "etag" in headers or "last-modified" in headers)
+
+    def store(self, url: str, headers: dict, body: str):
+        """Store a 200 response if its headers allow it to be reused"""
+        with self.lock:
+            if not self.is_storable(headers):
+                self.remove(url)
+                return
+            entry = CacheEntry(body, headers.get("etag"), headers.get("last-modified"),
+                               time.time() + freshness_lifetime(headers))
+            self._put_memory(url, entry)
+            self._write_disk(url, entry)
+
+    def revalidated(self, url: str, entry: CacheEntry, headers: dict):
+        """Refresh an entry after the server answered 304 Not Modified"""
+        with self.lock:
+            entry.expires = time.time() + freshness_lifetime(headers)
+            entry.etag = headers.get("etag", entry.etag)
+            entry.last_modified = headers.get("last-modified", entry.last_modified)
+            self._write_disk(url, entry)
+
+    def remove(self, url: str):
+        with self.lock:
+            entry = self.entries.pop(url, None)
+            if entry is not None:
+                self.size -= entry.size
+            if self.directory:
+                try:
+                    os.remove(self._disk_path(url))
+                except OSError:
+                    pass
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def _put_memory(self, url: str, entry: CacheEntry):
+        old = self.entries.pop(url, None)
+        if old is not None:
+            self.size -= old.size
+        if entry.size > self.max_bytes:
+            return
+        self.entries[url] = entry
+        self.size += entry.size
+        while self.size > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= evicted.size
+
+    def _disk_path(self, url: str) -> str:
+        name = hashlib.sha256(url.encode("utf8")).hexdigest()
+        return os.path.join(self.directory, name + ".json")
+
+    def _read_disk(self, url: str):
+        if not self.directory:
+            return None
+        try:
+            with open(self._disk_path(url), "r", encoding="utf8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return CacheEntry(data["body"], data["etag"], data["last_modified"], data["expires"])
+
+    def _write_disk(self, url: str, entry: CacheEntry):
+        if not self.directory:
+            return
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(self._disk_path(url), "w", encoding="utf8") as f:
+                json.dump(entry.to_json(), f)
+        except OSError:
+            pass
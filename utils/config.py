@@ -1,3 +1,5 @@
+import os
+
 INITIAL_WIDTH, INITIAL_HEIGHT = 800, 600
 
 
@@ -6,6 +8,8 @@ class Config:
     height = INITIAL_HEIGHT
 
     SCROLL_STEP = 100
+    # Most frames drawn per second, input events in between are handled together
+    FRAME_RATE = 60
 
     HSTEP, VSTEP = 13, 18
 
@@ -25,6 +29,36 @@ class Config:
     }
     INPUT_WIDTH_PX = 200
 
+    # Largest (decoded) response body accepted, None for no limit
+    MAX_BODY_BYTES = 64 * 1024 * 1024
+
+    # Number of (font, word) widths kept by utils.fonts.MEASURE_CACHE
+    MEASURE_CACHE_SIZE = 50000
+
+    # "tk" asks Tk to measure every string, "table" sums per-character widths measured
+    # once and kept in GLYPH_CACHE_FILE
+    METRICS_BACKEND = "tk"
+    GLYPH_CACHE_FILE = os.path.join(os.path.expanduser("~"), ".cache", "browser", "glyph_widths.json")
+
+    # Only lay out the page as far as the viewport plus LAYOUT_MARGIN pixels, and continue
+    # while scrolling down
+    LAZY_LAYOUT = True
+    LAYOUT_MARGIN = 1000
+
+    # Characters parsed between partial renders while waiting for the first screenful
+    PROGRESSIVE_RENDER_STEP = 16 * 1024
+
+    # Worker threads loading pages in the background
+    LOADER_THREADS = 4
+    # Seconds a connect or read may block before the request fails
+    SOCKET_TIMEOUT = 30
+    # Seconds between checks that a partial render is still wanted, see Tab.fetch()
+    HANDOFF_POLL_INTERVAL = 0.1
+
+    CACHE_MAX_BYTES = 32 * 1024 * 1024
+    # Directory of the on-disk response cache, None to keep responses in memory only
+    CACHE_DIR = None
+
     @classmethod
     def set_width(cls, width):
         Config.width = width
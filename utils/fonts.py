@@ -1,13 +1,89 @@
 import tkinter
+from collections import OrderedDict
 from tkinter import font
 
+from utils.config import Config
+from utils.metrics import TkMetrics
+
 FONTS = {}
 
 
-def get_font(size, weight, style):
+class FontHandle:
+    """
+    A font together with its metrics, which are computed once per (size, weight, style)
+    by the metrics backend. The Tk font is only created when it is needed, so layout can
+    run without Tk when the backend doesn't need it
+    """
+
+    def __init__(self, key):
+        self.key = key
+        self._tk_font = None
+        self._label = None
+        self.ascent, self.descent, self.linespace = METRICS.vertical_metrics(self)
+        self.space_width = self.measure(" ")
+
+    @property
+    def tk_font(self) -> tkinter.font.Font:
+        if self._tk_font is None:
+            size, weight, style = self.key
+            self._tk_font = tkinter.font.Font(size=size, weight=weight, slant=style)
+            self._label = tkinter.Label(font=self._tk_font)
+        return self._tk_font
+
+    def measure(self, text: str) -> int:
+        return MEASURE_CACHE.measure(self, text)
+
+
+def get_font(size, weight, style) -> FontHandle:
     key = (size, weight, style)
     if key not in FONTS:
-        font_ = tkinter.font.Font(size=size, weight=weight, slant=style)
-        label = tkinter.Label(font=font_)
-        FONTS[key] = (font_, label)
-    return FONTS[key][0]
+        FONTS[key] = FontHandle(key)
+    return FONTS[key]
+
+
+def set_metrics_backend(backend):
+    """Measure text with `backend` from now on, forgetting fonts measured by the old one"""
+    global METRICS
+    METRICS = backend
+    FONTS.clear()
+    MEASURE_CACHE.clear()
+
+
+class MeasureCache:
+    """Bounded LRU cache of text widths keyed by (font key, text), with hit counters"""
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def measure(self, font_: FontHandle, text: str) -> int:
+        key = (font_.key, text)
+        width = self.entries.get(key)
+        if width is not None:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return width
+        self.misses += 1
+        width = METRICS.measure(font_, text)
+        self.entries[key] = width
+        if len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        return width
+
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def clear(self):
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+# Shared by every layout in every tab
+MEASURE_CACHE = MeasureCache(Config.MEASURE_CACHE_SIZE)
+
+# The browser switches to glyph tables when Config.METRICS_BACKEND is "table"
+METRICS = TkMetrics()
@@ -0,0 +1,141 @@
+import atexit
+import json
+import os
+import tkinter
+
+
+class GlyphTable:
+    """Vertical metrics and per-character advance widths of one font"""
+    # Characters measured up front: printable ASCII and Latin-1
+    CHARACTERS = "".join(chr(c) for c in list(range(0x20, 0x7f)) + list(range(0xa0, 0x100)))
+
+    def __init__(self, ascent: int, descent: int, linespace: int, widths: dict):
+        self.ascent = ascent
+        self.descent = descent
+        self.linespace = linespace
+        self.widths = widths
+        # Used for characters that are not in the table and can't be measured
+        self.default_width = round(sum(widths.values()) / len(widths)) if widths else 0
+
+    @classmethod
+    def from_tk(cls, tk_font):
+        metrics = tk_font.metrics()
+        widths = {char: tk_font.measure(char) for char in cls.CHARACTERS}
+        return cls(metrics["ascent"], metrics["descent"], metrics["linespace"], widths)
+
+    @classmethod
+    def from_json(cls, data: dict):
+        return cls(data["ascent"], data["descent"], data["linespace"], data["widths"])
+
+    def to_json(self) -> dict:
+        return {
+            "ascent": self.ascent,
+            "descent": self.descent,
+            "linespace": self.linespace,
+            "widths": self.widths,
+        }
+
+    def measure(self, text: str) -> int:
+        get = self.widths.get
+        default = self.default_width
+        return sum([get(char, default) for char in text])
+
+
+class TkMetrics:
+    """Measure every string with Tk. Exact, but needs a Tk interpreter"""
+
+    def vertical_metrics(self, font_):
+        metrics = font_.tk_font.metrics()
+        return metrics["ascent"], metrics["descent"], metrics["linespace"]
+
+    def measure(self, font_, text: str) -> int:
+        return font_.tk_font.measure(text)
+
+
+class GlyphTableMetrics:
+    """
+    Measure strings by summing per-character widths from glyph tables. With a Tk `root`,
+    tables are measured the first time a font is used and persisted to `path`, keyed by
+    the resolved font family and the Tk scaling as well as (size, weight, style). Without
+    one, the tables last persisted for each font are used as they are. Kerning is ignored,
+    so widths can differ from Tk by a pixel or so per word
+    """
+    VERSION = 2
+
+    def __init__(self, path=None, root: tkinter.Misc = None):
+        self.path = path
+        self.root = root
+        self.scaling = float(root.tk.call("tk", "scaling")) if root is not None else None
+        # (size, weight, style) -> table, for the fonts used so far
+        self.tables = {}
+        # (family, scaling, size, weight, style) -> table, as persisted
+        self.stored = {}
+        # (size, weight, style) -> the last stored table, for use without Tk
+        self.latest = {}
+        self.dirty = False
+        if path:
+            self.load()
+            atexit.register(self.save)
+
+    def add_table(self, key, table: GlyphTable):
+        self.tables[key] = table
+
+    def table(self, font_) -> GlyphTable:
+        table = self.tables.get(font_.key)
+        if table is None:
+            if self.root is None:
+                table = self.latest.get(font_.key)
+                if table is None:
+                    raise LookupError("No glyph table for font {} and no Tk to measure it".format(font_.key))
+            else:
+                key = (font_.tk_font.actual("family"), self.scaling) + font_.key
+                table = self.stored.get(key)
+                if table is None:
+                    table = GlyphTable.from_tk(font_.tk_font)
+                    self.stored[key] = table
+                    self.dirty = True
+            self.tables[font_.key] = table
+        return table
+
+    def vertical_metrics(self, font_):
+        table = self.table(font_)
+        return table.ascent, table.descent, table.linespace
+
+    def measure(self, font_, text: str) -> int:
+        table = self.table(font_)
+        if self.root is not None:
+            # Learn characters outside the table the first time they are seen
+            for char in text:
+                if char not in table.widths:
+                    table.widths[char] = font_.tk_font.measure(char)
+                    self.dirty = True
+        return table.measure(text)
+
+    def load(self):
+        try:
+            with open(self.path, "r", encoding="utf8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        if data.get("version") != self.VERSION:
+            return
+        for entry in data["fonts"]:
+            table = GlyphTable.from_json(entry["table"])
+            self.stored[tuple(entry["key"])] = table
+            self.latest[tuple(entry["key"][2:])] = table
+
+    def save(self):
+        if not self.path or not self.dirty:
+            return
+        data = {
+            "version": self.VERSION,
+            "fonts": [{"key": key, "table": table.to_json()} for key, table in self.stored.items()],
+        }
+        try:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with open(self.path, "w", encoding="utf8") as f:
+                json.dump(data, f)
+        except OSError:
+            return
+        self.dirty = False
+
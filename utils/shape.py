@@ -7,3 +7,7 @@ class Rect:
 
     def contains_point(self, x, y):
         return self.left <= x < self.right and self.top <= y < self.bottom
+
+    def union(self, other):
+        return Rect(min(self.left, other.left), min(self.top, other.top),
+                    max(self.right, other.right), max(self.bottom, other.bottom))
@@ -1,15 +1,232 @@
-import gzip
+import codecs
+import select
 import socket
 import ssl
+import threading
+import time
+import zlib
+
+from utils.cache import ResponseCache
+from utils.config import Config
 
 
 class URLMalformedException(Exception):
     pass
 
 
+class ResponseTooLargeException(Exception):
+    pass
+
+
+class Connection:
+    """A persistent HTTP/1.1 connection to one (scheme, host, port)"""
+    NO_BODY_STATUSES = ["204", "304"]
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, scheme: str, host: str, port: int):
+        self.key = (scheme, host, port)
+        s = socket.socket(
+            family=socket.AF_INET,
+            type=socket.SOCK_STREAM,
+            proto=socket.IPPROTO_TCP,
+        )
+        # A stalled server fails the request instead of holding its loader thread forever
+        s.settimeout(Config.SOCKET_TIMEOUT)
+        if scheme == "https":
+            s = ssl_context().wrap_socket(s, server_hostname=host)
+        s.connect((host, port))
+        self.socket = s
+        self.response = s.makefile("rb")
+        self.keep_alive = True
+        self.reused = False
+        self.last_used = time.monotonic()
+
+    def send(self, request: bytes):
+        """
+        Send a request and read the response head
+        :return: the status code and the response headers
+        """
+        self.socket.sendall(request)
+
+        # An interim (1xx) response has no body and is followed by the real one
+        version, status, response_headers = self._read_head()
+        while status.startswith("1"):
+            version, status, response_headers = self._read_head()
+
+        if version == "HTTP/1.0" or response_headers.get("connection", "").casefold() == "close":
+            self.keep_alive = False
+        return status, response_headers
+
+    def _read_head(self):
+        statusline = self.response.readline().decode("utf-8")
+        if not statusline:
+            raise ConnectionResetError("Connection closed by server")
+        # The reason phrase is optional
+        version, status = statusline.split(None, 2)[:2]
+
+        response_headers = {}
+        while True:
+            line = self.response.readline().decode("utf-8")
+            if line in ("\r\n", ""):
+                break
+            header, value = line.split(":", 1)
+            response_headers[header.casefold()] = value.strip()
+        return version, status, response_headers
+
+    def iter_body(self, status: str, response_headers: dict):
+        """
+        Yield the raw body of one response in pieces, undoing chunked transfer framing,
+        so the connection can carry the next request once the generator is exhausted
+        """
+        if status in self.NO_BODY_STATUSES:
+            return
+        if "chunked" in response_headers.get("transfer-encoding", "").casefold():
+            yield from self._iter_chunked()
+        elif "content-length" in response_headers:
+            remaining = int(response_headers["content-length"])
+            while remaining > 0:
+                data = self.response.read(min(remaining, self.CHUNK_SIZE))
+                if not data:
+                    raise ConnectionResetError("Connection closed before end of body")
+                remaining -= len(data)
+                yield data
+        else:
+            # Without framing the body only ends when the server closes the connection
+            self.keep_alive = False
+            while True:
+                data = self.response.read1(self.CHUNK_SIZE)
+                if not data:
+                    break
+                yield data
+
+    def _iter_chunked(self):
+        while True:
+            line = self.response.readline()
+            if not line:
+                raise ConnectionResetError("Connection closed inside chunked body")
+            size = int(line.split(b";", 1)[0].strip(), 16)
+            if size == 0:
+                break
+            remaining = size
+            while remaining > 0:
+                data = self.response.read(min(remaining, self.CHUNK_SIZE))
+                if not data:
+                    raise ConnectionResetError("Connection closed inside chunk")
+                remaining -= len(data)
+                yield data
+            self.response.readline()
+        # Skip trailer headers
+        while self.response.readline() not in (b"\r\n", b""):
+            pass
+
+    def is_stale(self) -> bool:
+        """An idle connection that is readable has been closed (or broken) by the server"""
+        try:
+            readable, _, _ = select.select([self.socket], [], [], 0)
+        except (OSError, ValueError):
+            return True
+        return bool(readable)
+
+    def close(self):
+        try:
+            self.response.close()
+            self.socket.close()
+        except OSError:
+            pass
+
+
+class ConnectionPool:
+    """Idle keep-alive connections, keyed by (scheme, host, port)"""
+    MAX_IDLE_PER_HOST = 6
+    IDLE_TIMEOUT = 30
+
+    def __init__(self):
+        self.idle = {}
+        # Guards `idle`, loader threads take and return connections concurrently
+        self.lock = threading.Lock()
+
+    def acquire(self, scheme: str, host: str, port: int) -> Connection:
+        """Return an idle connection to this origin if a live one exists, else open a new one"""
+        now = time.monotonic()
+        while True:
+            with self.lock:
+                connections = self.idle.get((scheme, host, port))
+                if not connections:
+                    break
+                conn = connections.pop()
+            if now - conn.last_used < self.IDLE_TIMEOUT and not conn.is_stale():
+                conn.reused = True
+                return conn
+            conn.close()
+        return self.connect(scheme, host, port)
+
+    def connect(self, scheme: str, host: str, port: int) -> Connection:
+        return Connection(scheme, host, port)
+
+    def release(self, conn: Connection):
+        """Return a connection whose response has been fully read back to the pool"""
+        with self.lock:
+            connections = self.idle.setdefault(conn.key, [])
+            if len(connections) < self.MAX_IDLE_PER_HOST:
+                conn.last_used = time.monotonic()
+                connections.append(conn)
+                return
+        conn.close()
+
+    def clear(self):
+        with self.lock:
+            idle = self.idle
+            self.idle = {}
+        for connections in idle.values():
+            for conn in connections:
+                conn.close()
+
+
+_SSL_CONTEXT = None
+
+
+def ssl_context() -> ssl.SSLContext:
+    global _SSL_CONTEXT
+    if _SSL_CONTEXT is None:
+        _SSL_CONTEXT = ssl.create_default_context()
+    return _SSL_CONTEXT
+
+
+def decode_body(chunks, content_encoding=None, max_size=None):
+    """
+    Incrementally gunzip (if needed) and utf-8 decode raw body pieces into text pieces
+    :param chunks: iterable of bytes
+    :param content_encoding: value of the Content-Encoding header
+    :param max_size: maximum decoded body size in bytes, None for no limit
+    """
+    decompressor = None
+    if content_encoding == "gzip":
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    decoder = codecs.getincrementaldecoder("utf8")()
+    size = 0
+    for chunk in chunks:
+        if decompressor:
+            chunk = decompressor.decompress(chunk)
+        size += len(chunk)
+        if max_size is not None and size > max_size:
+            raise ResponseTooLargeException("Response body exceeds {} bytes".format(max_size))
+        text = decoder.decode(chunk)
+        if text:
+            yield text
+    tail = decompressor.flush() if decompressor else b""
+    text = decoder.decode(tail, final=True)
+    if text:
+        yield text
+
+
+CONNECTION_POOL = ConnectionPool()
+RESPONSE_CACHE = ResponseCache(Config.CACHE_MAX_BYTES, Config.CACHE_DIR)
+
+
 class URL:
     _SUPPORTED_SCHEME = ["http", "https", "file", "data", "view-source", "about"]
     _MAX_REDIRECTS = 2
+    _REDIRECT_STATUSES = ["301", "302", "303", "307", "308"]
 
     def __init__(self, url: str, n_redirects: int = 0):
         self.full_url = url
@@ -36,34 +253,88 @@ class URL:
             self.url = "blank"
 
     def request(self, payload=None) -> str:
+        return "".join(self.stream(payload))
+
+    def stream(self, payload=None, max_size=Config.MAX_BODY_BYTES):
+        """Yield the response body as text pieces as they arrive"""
         if self.scheme == "http" or self.scheme == "https":
-            return self._request_http_and_https(payload)
+            return self._stream_http_and_https(payload, max_size)
         elif self.scheme == "file":
-            return self._request_file()
+            return self._stream_file()
         elif self.scheme == "data":
-            return self._request_data()
+            return iter([self._request_data()])
         elif self.scheme == "view-source":
-            return self._request_view_source()
+            return self.sub_url._stream_http_and_https(None, max_size)
         elif self.scheme == "about":
-            return self._request_about()
+            return iter([self._request_about()])
 
-    def _request_http_and_https(self, payload=None) -> str:
-        s = socket.socket(
-            family=socket.AF_INET,
-            type=socket.SOCK_STREAM,
-            proto=socket.IPPROTO_TCP,
-        )
-        method = "POST" if payload else "GET"
-        if self.scheme == "https":
-            ctx = ssl.create_default_context()
-            s = ctx.wrap_socket(s, server_hostname=self.host)
+    def _stream_http_and_https(self, payload=None, max_size=None, use_cache=True):
+        # Only plain GETs are cacheable
+        cache_key = str(self)
+        entry = None if payload or not use_cache else RESPONSE_CACHE.get(cache_key)
+        if entry is not None and entry.is_fresh():
+            yield entry.body
+            return
+
+        if entry is not None:
+            extra_headers = entry.validators()
+        elif use_cache:
+            extra_headers = {}
+        else:
+            # Don't let a cache on the way answer with another 304
+            extra_headers = {"Cache-Control": "no-cache"}
+        conn, status, response_headers = self._send(payload, extra_headers)
+        body = conn.iter_body(status, response_headers)
 
-        s.connect((self.host, self.port))
-        request = "{} {} HTTP/1.0\r\n".format(method, self.path)
+        if status == "304":
+            self._finish(conn, body)
+            if entry is not None:
+                RESPONSE_CACHE.revalidated(cache_key, entry, response_headers)
+                yield entry.body
+            elif use_cache:
+                # Nothing cached to reuse, ask once more without going through the cache
+                yield from self._stream_http_and_https(payload, max_size, use_cache=False)
+            return
+        if (status in self._REDIRECT_STATUSES and "location" in response_headers
+                and self.n_redirects < self._MAX_REDIRECTS):
+            self._finish(conn, body)
+            redirect_url = response_headers["location"]
+            yield from URL(self._parse_redirect_url(redirect_url), self.n_redirects + 1).stream(max_size=max_size)
+            return
+
+        cacheable = not payload and status == "200" and RESPONSE_CACHE.is_storable(response_headers)
+        if not cacheable and entry is not None:
+            RESPONSE_CACHE.remove(cache_key)
+        pieces = []
+        complete = False
+        try:
+            for text in decode_body(body, response_headers.get("content-encoding"), max_size):
+                if cacheable:
+                    pieces.append(text)
+                yield text
+            complete = True
+        finally:
+            if complete and conn.keep_alive:
+                CONNECTION_POOL.release(conn)
+            else:
+                # A partially read response leaves the connection unusable
+                conn.close()
+        if cacheable:
+            RESPONSE_CACHE.store(cache_key, response_headers, "".join(pieces))
+
+    def _send(self, payload=None, extra_headers=None):
+        """
+        Send one request over a pooled connection
+        :return: the connection, status code and response headers
+        """
+        method = "POST" if payload else "GET"
+        request = "{} {} HTTP/1.1\r\n".format(method, self.path)
         request += "Host: {}\r\n".format(self.host)
-        request += "Connection: {}\r\n".format("close")
+        request += "Connection: {}\r\n".format("keep-alive")
         request += "User-Agent: {}\r\n".format("Quack Quack")
         request += "Accept-Encoding: {}\r\n".format("gzip")
+        for header, value in (extra_headers or {}).items():
+            request += "{}: {}\r\n".format(header, value)
         if payload:
             length = len(payload.encode("utf8"))
             request += "Content-Length: {}\r\n".format(length)
@@ -72,45 +343,40 @@ class URL:
         # Append payload after header
         if payload:
             request += payload
-        s.send(request.encode("utf8"))
 
-        response = s.makefile("rb", encoding="utf8", newline="\r\n")
-
-        statusline = response.readline().decode('utf-8')
-        version, status, explanation = statusline.split(" ", 2)
+        conn = CONNECTION_POOL.acquire(self.scheme, self.host, self.port)
+        try:
+            status, response_headers = conn.send(request.encode("utf8"))
+        except (OSError, ValueError):
+            # An idle connection may have been closed by the server in the meantime
+            conn.close()
+            if not conn.reused:
+                raise
+            conn = CONNECTION_POOL.connect(self.scheme, self.host, self.port)
+            status, response_headers = conn.send(request.encode("utf8"))
+        return conn, status, response_headers
 
-        response_headers = {}
-        while True:
-            line = response.readline().decode('utf-8')
-            if line == "\r\n":
-                break
-            header, value = line.split(":", 1)
-            response_headers[header.casefold()] = value.strip()
+    @staticmethod
+    def _finish(conn: Connection, body):
+        """Drain a body we are not interested in and give the connection back to the pool"""
+        for _ in body:
+            pass
+        if conn.keep_alive:
+            CONNECTION_POOL.release(conn)
+        else:
+            conn.close()
 
-        if status.startswith("3"):
-            if self.n_redirects < self._MAX_REDIRECTS:
-                redirect_url = response_headers["location"]
-                content = URL(self._parse_redirect_url(redirect_url), self.n_redirects + 1).request()
-                s.close()
-                return content
-        if "content-encoding" not in response_headers:
-            content = response.read().decode("utf8")
-        elif response_headers["content-encoding"] == "gzip":
-            content = gzip.decompress(response.read()).decode("utf-8")
-        s.close()
-
-        return content
-
-    def _request_file(self) -> str:
+    def _stream_file(self):
         with open(self.url, "r") as f:
-            return f.read()
+            while True:
+                text = f.read(Connection.CHUNK_SIZE)
+                if not text:
+                    break
+                yield text
 
     def _request_data(self) -> str:
         return self.data
 
-    def _request_view_source(self) -> str:
-        return self.sub_url._request_http_and_https()
-
     def _request_about(self) -> str:
         return ""
 